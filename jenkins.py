@@ -1,6 +1,3 @@
-from __future__ import (absolute_import, division, print_function)
-__metaclass__ = type
-
 DOCUMENTATION = '''
     name: jenkins
     plugin_type: inventory
@@ -8,6 +5,8 @@ DOCUMENTATION = '''
     description:
         - Get inventory hosts from jenkins instance
         - Uses a .jenkins.yaml (or .jenkins.yml) YAML configuration file.
+    requirements:
+        - python >= 3.9
     extends_documentation_fragment:
         - constructed
         - inventory_cache
@@ -16,7 +15,7 @@ DOCUMENTATION = '''
             description: jenkins user
             type: string
         jenkins_pass:
-            description: jenkins password
+            description: jenkins password or api token (32 hexadecimal digits, 34 the newer ones)
             type: string
         jenkins_host:
             description: jenkins host
@@ -24,9 +23,173 @@ DOCUMENTATION = '''
         jenkins_jsessionid:
             description: force login to use jsessionid and improve performance
             type: boolean
+        masters:
+            description:
+                - Several jenkins masters, read at the same time and merged in one inventory.
+                - Every item is a dict with the C(jenkins_host) of the master and, optionally, its C(name)
+                  (the host of the url by default) and its C(jenkins_user), C(jenkins_pass),
+                  C(jenkins_jsessionid), C(timeout) or any other option of this plugin, but the ones of the
+                  whole inventory (C(masters), C(master_hosts), C(master_groups), C(label_groups),
+                  C(snapshot_path) and C(metrics_file)). They are checked and converted to their type.
+                - Every master is cached on its own, so only the expired ones are read again.
+                - Every host gets the C(jenkins_master) variable, with the name of its master.
+            type: list
+            elements: dict
+        master_hosts:
+            description:
+                - What to do with the computers with the same name in several masters.
+                - C(keep) keeps the variables of the first master listed, the host is in the groups of every master.
+                - C(prefix) names every host C(<master name>_<computer name>).
+            type: string
+            choices: ['keep', 'prefix']
+            default: keep
+        master_groups:
+            description: add a group per master, named as the master, with its hosts
+            type: boolean
+            default: False
+        cache_mode:
+            description:
+                - C(default) waits for jenkins whenever the cache expires.
+                - C(stale_while_revalidate) answers right away with the last inventory read (if it's not
+                  older than C(max_stale)) and refreshes the cache in a background process, only one at a time.
+            type: string
+            choices: ['default', 'stale_while_revalidate']
+            default: default
+        max_stale:
+            description: seconds after which the last inventory read is too old to be used by C(stale_while_revalidate)
+            type: int
+            default: 86400
+        cache_format:
+            description:
+                - C(json) caches the inventory data as it is.
+                - C(compact) caches it with every string stored once, compressed and with a schema version,
+                  so it is smaller and faster to load with big jenkins instances. A cache written with another
+                  format or schema version is read again from jenkins.
+            type: string
+            choices: ['json', 'compact']
+            default: json
+        jsessionid_cache:
+            description:
+                - Keep the jsessionid cookie between runs (in C(state_dir)), so we don't login every time.
+                - We login again if jenkins does not accept the cookie anymore.
+            type: boolean
+            default: False
+        jsessionid_ttl:
+            description: seconds a cached jsessionid cookie is used before login again
+            type: int
+            default: 1800
         timeout:
             description: timeout for each request
             type: int
+        deadline:
+            description:
+                - Seconds the whole read of jenkins can take, login and listing included.
+                - The computers not read by then, or whose request failed, get the last data known of them (see
+                  C(node_cache), always kept with a deadline) and the C(jenkins_stale) variable. The ones never read
+                  before are left out. A warning tells how many of them there were.
+                - Requests never wait past the deadline, whatever the C(timeout), and are not retried after it.
+                - An inventory with stale computers is not cached.
+            type: float
+        max_workers:
+            description:
+                - Maximum number of computer configurations fetched concurrently.
+                - Use 1 to fetch them one after the other.
+            type: int
+            default: 1
+        adaptive_concurrency:
+            description:
+                - Start with one request at a time and grow up to C(max_workers) while jenkins answers
+                  within C(target_latency), halving it when jenkins is slow or answers 429/503.
+                - Use it when several inventories hit the same jenkins at the same time.
+            type: boolean
+            default: False
+        target_latency:
+            description: answer time, in seconds, above which C(adaptive_concurrency) thinks jenkins is struggling
+            type: float
+            default: 1.0
+        retries:
+            description:
+                - Times a GET request is retried when jenkins answers 429, 502, 503 or 504, or the connection fails.
+                - Every retry waits a random time, growing exponentially, or what jenkins asked for (Retry-After).
+                - The POST requests (login and C(fetch_mode=script)) are never retried.
+            type: int
+            default: 0
+        retry_timeouts:
+            description:
+                - Retry the GET requests that timed out too. Every retry can wait the whole C(timeout) again.
+            type: boolean
+            default: False
+        engine:
+            description:
+                - How the config.xml requests are driven when C(fetch_mode) is C(config).
+                - C(threads) uses a pool of C(max_workers) threads.
+                - C(async) uses a single asyncio event loop with up to C(max_workers) requests at the
+                  same time, without a thread per request. Meant for jenkins with thousands of computers.
+            type: string
+            choices: ['threads', 'async']
+            default: threads
+        fetch_mode:
+            description:
+                - How the computers are read from jenkins.
+                - C(config) lists the computers and reads the config.xml of each one of them.
+                - C(script) runs a single groovy script in the jenkins script console that returns
+                  every computer at once. The user needs the Overall/RunScripts permission,
+                  without it we fall back to C(config).
+                - The script is sent with a crumb (CSRF protection), but with an api token as C(jenkins_pass),
+                  that jenkins does not ask for.
+            type: string
+            choices: ['config', 'script']
+            default: config
+        include:
+            description:
+                - Only the computers matching this filter are added to the inventory.
+                - C(names) is a list of regular expressions searched in the computer name.
+                - C(labels) is a list of jenkins labels.
+                - C(state) is a list of states, from C(online), C(offline), C(idle), C(busy) and C(temporarily_offline).
+                - A computer matches if it matches any value of every key given.
+                - The filter is evaluated with the computers list, so the config.xml of the
+                  computers left out is never requested.
+            type: dict
+            default: {}
+        exclude:
+            description:
+                - The computers matching this filter are not added to the inventory.
+                - Same format as C(include).
+            type: dict
+            default: {}
+        label_groups:
+            description:
+                - Groups of the computers matching a jenkins label expression, by group name.
+                - The expressions use the labels of the computers and their names, quoted if they have spaces
+                  or operators, and the operators C(!), C(&&), C(||), C(->), C(<->) and parentheses.
+                - Like in jenkins, C(->) and C(<->) cannot be chained, C(a -> (b -> c)) needs the parentheses.
+                - Every expression is parsed once, and evaluated once for every different set of the labels it uses.
+                - They are evaluated when the inventory is built, so a change is seen with the cached data too.
+            type: dict
+            default: {}
+        node_cache:
+            description:
+                - Keep every computer configuration between runs, so only the ones changed since the last
+                  run are parsed again.
+                - Jenkins validators (ETag/Last-Modified) are sent so it can answer "not modified".
+            type: boolean
+            default: False
+        state_dir:
+            description: directory where the plugin keeps its own files between runs
+            type: path
+            default: ~/.ansible/jenkins_inventory
+        snapshot_path:
+            description:
+                - Snapshot file the inventory is read from, jenkins and the cache are not used.
+                - It is written running this file, C(python jenkins.py <inventory file>), from cron for example.
+                  The snapshot has an index, C(python jenkins.py --snapshot <path> --host <host>) reads only
+                  the variables of that host.
+            type: path
+        metrics_file:
+            description:
+                - File where the timings and counters of every run are appended, one json object per line.
+                - They are shown with -vvv too.
+            type: path
 '''
 
 EXAMPLES = '''
@@ -41,15 +204,34 @@ simple_config_file:
     jenkins_jsessionid: True
     jenkins_host: http://127.0.0.1:8080/
     timeout: 30
+    max_workers: 8
 '''
 
+import argparse
+import base64
+import copy
+import fcntl
+import hashlib
+import heapq
+import importlib
+import json
+import os
+import random
+import re
+import socket
 import sys
-
+import threading
+import time
+import zlib
+from email.parser import Parser
+from io import BytesIO
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from urllib.parse import quote, urlencode, urljoin, urlsplit
+
+from ansible.config.manager import ensure_type
 from ansible.errors import AnsibleError
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
-from ansible.module_utils.urls import open_url
-from ansible.module_utils.six.moves.urllib.parse import urlencode
-from ansible.module_utils.six.moves.urllib.request import Request, HTTPRedirectHandler, build_opener
 
 try:
     from __main__ import display
@@ -57,13 +239,1379 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
-from lxml import objectify
-import getpass
+import jinja2
+import yaml
+
+
+class LazyModule(object):
+    ''' Module imported the first time one of its attributes is used.
+
+        For the modules only needed to read jenkins, or to ask for the
+        password, so a cached inventory doesn't load them. Once imported,
+        the module replaces the proxy in the globals of this file.
+    '''
+
+    def __init__(self, name, global_name):
+        self._name = name
+        self._global_name = global_name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        globals()[self._global_name] = module
+        return getattr(module, attribute)
+
+
+asyncio = LazyModule('asyncio', 'asyncio')
+concurrent_futures = LazyModule('concurrent.futures', 'concurrent_futures')
+etree = LazyModule('lxml.etree', 'etree')
+getpass = LazyModule('getpass', 'getpass')
+http_client = LazyModule('http.client', 'http_client')
+mmap = LazyModule('mmap', 'mmap')
+objectify = LazyModule('lxml.objectify', 'objectify')
+ssl = LazyModule('ssl', 'ssl')
+
+
+DEFAULT_STATE_DIR = '~/.ansible/jenkins_inventory'
+
+MASTER_COMPUTER_CLASS = 'hudson.model.Hudson$MasterComputer'
+
+# Jenkins api tokens, the legacy ones and the ones with the hash version
+API_TOKEN = re.compile(r'(?:11)?[0-9a-f]{32}')
+
+# _class is always sent by jenkins
+COMPUTER_FIELDS = 'displayName,idle,offline,temporarilyOffline,numExecutors'
+
+# We don't want anyone to override those properties, it could lead to serious problems if it happens
+FORBIDDEN_PROPERTIES = ('launcher_plugin',
+                        'inventory_hostname',
+                        'ansible_host',
+                        'ansible_port',
+                        'temporary_offline')
+
+# Prints every computer (but the master) as a json list. Each computer
+#  has the fields of computer/api/json, plus what we read from config.xml
+COMPUTERS_SCRIPT = '''
+import groovy.json.JsonOutput
+import hudson.slaves.EnvironmentVariablesNodeProperty
+import jenkins.model.Jenkins
+
+def jenkins = Jenkins.instance
+def computers = []
+
+jenkins.computers.each { computer ->
+    def node = computer.node
+    if (node == null || computer instanceof Jenkins.MasterComputer) {
+        return
+    }
+
+    def launcher = node.hasProperty('launcher') ? node.launcher : null
+    def plugin = launcher == null ? null : jenkins.pluginManager.whichPlugin(launcher.getClass())
+    def envVars = node.nodeProperties.get(EnvironmentVariablesNodeProperty)
+
+    computers << [
+        _class: computer.getClass().name,
+        displayName: computer.displayName,
+        idle: computer.idle,
+        offline: computer.offline,
+        numExecutors: computer.numExecutors,
+        labelString: node.labelString,
+        launcher: plugin == null ? null : plugin.shortName + '@' + plugin.version,
+        host: launcher != null && launcher.hasProperty('host') ? launcher.host : null,
+        port: launcher != null && launcher.hasProperty('port') ? launcher.port : null,
+        temporaryOffline: computer.temporarilyOffline,
+        envVars: envVars == null ? [:] : envVars.envVars,
+    ]
+}
+
+println(JsonOutput.toJson(computers))
+'''
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+
+@lru_cache(maxsize=None)
+def objectify_type_checks():
+    # lxml.objectify guesses the type of every value, so str() of a value can
+    #  differ from its text: '007' -> '7', 'true' -> 'True', '.5' -> '0.5'...
+    return [(pytype.name, pytype.type_check)
+            for pytype in objectify.getRegisteredTypes()
+            if pytype.type_check is not None]
+
+
+@lru_cache(maxsize=4096)
+def objectify_text(text):
+    ''' Returns the same string str() returns for an objectify element with this text. '''
+    # Cached, the same labels and values are repeated in most computers
+    if text is None:
+        return ''
+
+    for type_name, type_check in objectify_type_checks():
+        try:
+            type_check(text)
+        except (ValueError, TypeError):
+            continue
+        if type_name == 'int':
+            return str(int(text))
+        if type_name == 'float':
+            return str(float(text))
+        if type_name == 'bool':
+            return str(text.strip() in ('true', '1'))
+
+    return text
+
+
+CONFIG_TAGS = ('label', 'launcher', 'temporaryOfflineCause', 'tree-map')
+
+ENV_VARS_PARENTS = ('envVars', 'hudson.slaves.EnvironmentVariablesNodeProperty', 'nodeProperties')
+
+
+class ComputerFilter(object):
+    ''' Computer filter (include/exclude options) evaluated against computer/api/json. '''
+
+    STATES = {
+        'online': lambda computer: not computer['offline'],
+        'offline': lambda computer: computer['offline'],
+        'idle': lambda computer: computer['idle'],
+        'busy': lambda computer: not computer['idle'],
+        'temporarily_offline': lambda computer: computer.get('temporarilyOffline', False),
+    }
+
+    def __init__(self, option_name, options):
+        options = options or {}
+        unknown = set(options) - set(['names', 'labels', 'state'])
+        if unknown:
+            raise AnsibleError('Unknown {0} filter keys: {1}'.format(option_name, ', '.join(sorted(unknown))))
+
+        try:
+            self.names = [re.compile(name) for name in options.get('names') or []]
+        except re.error as e:
+            raise AnsibleError('Invalid {0} name regular expression: {1}'.format(option_name, e))
+
+        self.labels = set(options.get('labels') or [])
+
+        self.states = list(options.get('state') or [])
+        for state in self.states:
+            if state not in self.STATES:
+                valid_states = ', '.join(sorted(self.STATES))
+                raise AnsibleError('Invalid {0} state {1}, valid ones are: {2}'.format(option_name, state, valid_states))
+
+    def __bool__(self):
+        return bool(self.names or self.labels or self.states)
+
+    def matches(self, computer):
+        if self.names and not any(name.search(computer['displayName']) for name in self.names):
+            return False
+
+        if self.labels:
+            labels = set(label['name'] for label in computer.get('assignedLabels', []))
+            if not self.labels & labels:
+                return False
+
+        if self.states and not any(self.STATES[state](computer) for state in self.states):
+            return False
+
+        return True
+
+
+# Operators, "quoted labels" and labels. A label can have dashes, but not
+#  the one of the -> operator
+LABEL_EXPRESSION_TOKEN = re.compile(r'\s*(?:(<->|->|&&|\|\||!|\(|\))|"((?:[^"\\]|\\.)*)"|((?:[^\s&|!()<>"-]|-(?!>))+))')
+
+
+def _label_not(operand):
+    return lambda bits: not operand(bits)
+
+
+def _label_binary(operator, left, right):
+    if operator == '&&':
+        return lambda bits: left(bits) and right(bits)
+    if operator == '||':
+        return lambda bits: left(bits) or right(bits)
+    if operator == '->':
+        return lambda bits: not left(bits) or right(bits)
+    return lambda bits: left(bits) == right(bits)
+
+
+def parse_label_expression(expression, label_bit):
+    ''' Jenkins label expression as a function of the label bits of a computer.
+
+        label_bit(label) gives the bit of every label. The operators are, from
+        the lowest precedence: <->, ->, ||, && and !. Like jenkins, <-> and ->
+        do not chain: a -> b -> c needs parentheses.
+        Raises ValueError if the expression is not valid.
+    '''
+    tokens = []
+    position = 0
+    while expression[position:].strip():
+        match = LABEL_EXPRESSION_TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError('unexpected "{0}"'.format(expression[position:].strip()))
+        operator, quoted, label = match.groups()
+        if operator is not None:
+            tokens.append((operator, None))
+        else:
+            tokens.append(('label', label if quoted is None else re.sub(r'\\(.)', r'\1', quoted)))
+        position = match.end()
+
+    tokens.append(('end', None))
+    index = [0]
+
+    def take(*operators):
+        if tokens[index[0]][0] in operators:
+            index[0] += 1
+            return tokens[index[0] - 1]
+        return None
+
+    def found():
+        token, label = tokens[index[0]]
+        if token == 'end':
+            return 'the end'
+        return '"{0}"'.format(label if token == 'label' else token)
+
+    def binary(operator, operand, chained=True):
+        def parse():
+            left = operand()
+            while take(operator):
+                left = _label_binary(operator, left, operand())
+                if not chained and tokens[index[0]][0] == operator:
+                    raise ValueError('"{0}" cannot be chained, use parentheses'.format(operator))
+            return left
+        return parse
+
+    def unary():
+        if take('!'):
+            return _label_not(unary())
+        if take('('):
+            inner = iff()
+            if not take(')'):
+                raise ValueError('missing ")"')
+            return inner
+        token = take('label')
+        if token is None:
+            raise ValueError('a label was expected, found {0}'.format(found()))
+        mask = label_bit(token[1])
+        return lambda bits: bits & mask != 0
+
+    iff = binary('<->', binary('->', binary('||', binary('&&', unary)), chained=False), chained=False)
+
+    matches = iff()
+    if not take('end'):
+        raise ValueError('unexpected {0}'.format(found()))
+    return matches
+
+
+class LabelGroups(object):
+    ''' Groups of the label_groups option, jenkins label expressions matched with the computer labels.
+
+        Every label used by the expressions gets a bit, so the labels of a
+        computer are an int and every expression a few bitwise operations.
+        Computers with the same bits are in the same groups, they are only
+        evaluated once.
+    '''
+
+    def __init__(self, expressions):
+        self.bits = {}
+        self.groups = []
+        for group, expression in (expressions or {}).items():
+            try:
+                self.groups.append((group, parse_label_expression(str(expression), self._label_bit)))
+            except ValueError as e:
+                raise AnsibleError('Invalid label expression of the group {0}: {1}. {2}'.format(group, expression, e))
+        self._matching = {}
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def _label_bit(self, label):
+        if label not in self.bits:
+            self.bits[label] = 1 << len(self.bits)
+        return self.bits[label]
+
+    def label_bits(self, labels):
+        # Labels not used by any expression don't change anything
+        bits = 0
+        for label in labels:
+            bits |= self.bits.get(label, 0)
+        return bits
+
+    def matching(self, labels):
+        bits = self.label_bits(labels)
+        groups = self._matching.get(bits)
+        if groups is None:
+            groups = self._matching[bits] = [group for group, matches in self.groups if matches(bits)]
+        return groups
+
+
+def _simple_text(element):
+    # objectify would not give us a simple value for an element with children
+    if len(element):
+        raise ValueError('<{0}> is not a simple value'.format(element.tag))
+    return objectify_text(element.text)
+
+
+def _is_env_vars(tree_map):
+    # .//nodeProperties/hudson.slaves.EnvironmentVariablesNodeProperty/envVars/tree-map
+    element = tree_map
+    for tag in ENV_VARS_PARENTS:
+        element = element.getparent()
+        if element is None or element.tag != tag:
+            return False
+    return element.getparent() is not None
+
+
+def intern_text(texts, text):
+    ''' The same object for every copy of a string read in a run.
+
+        texts is the table of the run, a plain dict instead of sys.intern
+        so the strings are released with it once the run is over.
+    '''
+    if text is None:
+        return None
+    return texts.setdefault(text, text)
+
+
+class ComputerRecord(object):
+    ''' What the inventory needs of a jenkins computer.
+
+        Thousands of them are alive at once, so they have no dict of their
+        own and the strings repeated from one computer to another (labels,
+        launcher plugins, environment variables...) are interned in texts,
+        the table of the run, so every record shares the same objects. The
+        host variables dict is only built when the computer is added to the
+        inventory data.
+
+        The name and the state (idle, offline, num_executors) come from the
+        computers list, the rest from the config.xml.
+    '''
+
+    __slots__ = ('name', 'labels', 'launcher_plugin', 'ansible_host', 'ansible_port', 'temporary_offline',
+                 'idle', 'offline', 'num_executors', 'properties', 'stale')
+
+    def __init__(self, labels, launcher_plugin, ansible_host, ansible_port, temporary_offline, properties,
+                 texts=None):
+        # properties: dict, (name, value) pairs or flat list of names and values
+        if isinstance(properties, dict):
+            properties = properties.items()
+        elif properties and not isinstance(properties[0], (list, tuple)):
+            # Already flat, from another record
+            properties = zip(properties[::2], properties[1::2])
+        if texts is None:
+            texts = {}
+        self.name = None
+        self.labels = tuple(intern_text(texts, label) for label in labels)
+        self.launcher_plugin = intern_text(texts, launcher_plugin)
+        self.ansible_host = intern_text(texts, ansible_host)
+        self.ansible_port = intern_text(texts, ansible_port)
+        self.temporary_offline = temporary_offline
+        self.idle = None
+        self.offline = None
+        self.num_executors = None
+        # name, value, name, value... in the order jenkins keeps them,
+        #  a single tuple takes less memory than a dict or a tuple per pair
+        self.properties = tuple(intern_text(texts, text) for prop in properties for text in prop)
+        self.stale = False
+
+    def set_state(self, computer):
+        ''' Adds what the computers list tells of the computer. '''
+        self.name = computer['displayName']
+        self.idle = computer['idle']
+        self.offline = computer['offline']
+        self.num_executors = computer['numExecutors']
+        return self
+
+    def stale_copy(self):
+        record = ComputerRecord(self.labels, self.launcher_plugin, self.ansible_host, self.ansible_port,
+                                self.temporary_offline, self.properties)
+        record.stale = True
+        return record
+
+    def host_vars(self):
+        host_vars = {}
+
+        host_vars['launcher_plugin'] = self.launcher_plugin
+
+        host_vars['inventory_hostname'] = self.name
+        if self.ansible_host is not None:
+            host_vars['ansible_host'] = self.ansible_host
+        if self.ansible_port is not None:
+            host_vars['ansible_port'] = self.ansible_port
+
+        host_vars['temporary_offline'] = self.temporary_offline
+
+        host_vars['idle'] = self.idle
+        host_vars['offline'] = self.offline
+        host_vars['num_executors'] = self.num_executors
+
+        properties = self.properties
+        for index in range(0, len(properties), 2):
+            host_vars[properties[index]] = properties[index + 1]
+
+        if self.stale:
+            host_vars['jenkins_stale'] = True
+
+        return host_vars
+
+    def to_state(self):
+        ''' What the node cache keeps of the config.xml. '''
+        return [list(self.labels), self.launcher_plugin, self.ansible_host, self.ansible_port,
+                self.temporary_offline, list(self.properties)]
+
+    @classmethod
+    def from_state(cls, state, texts=None):
+        if isinstance(state, dict):
+            # Node caches written before the records had slots
+            return cls(state['labels'], state['launcher_plugin'], state['ansible_host'], state['ansible_port'],
+                       state['temporary_offline'], state['properties'], texts)
+        return cls(*state, texts=texts)
+
+    def __eq__(self, other):
+        return (isinstance(other, ComputerRecord) and
+                all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ComputerRecord({0})'.format(', '.join('{0}={1!r}'.format(slot, getattr(self, slot))
+                                                      for slot in self.__slots__))
+
+
+def extract_computer_config(xml_config, texts=None):
+    ''' Reads from a config.xml only what the inventory uses.
+
+        The document is streamed, only the elements we need are handed
+        to us and everything read before them (cloud templates, retention
+        strategies...) is dropped on the go, so big configurations don't
+        need a full objectify tree. The record is the same one we get
+        from objectify, anything we can't read the same way (no launcher,
+        no label...) raises a ValueError so objectify can deal with it.
+    '''
+    label = None
+    launcher = None
+    temporary_offline = False
+    env_vars = None
+
+    try:
+        for _, element in etree.iterparse(BytesIO(xml_config), events=('end',), tag=CONFIG_TAGS):
+            parent = element.getparent()
+            if parent is not None and parent.getparent() is None:
+                # Direct child of the root element
+                if element.tag == 'label' and label is None:
+                    label = _simple_text(element)
+                elif element.tag == 'launcher' and launcher is None:
+                    plugin = element.attrib.get('plugin')
+                    if plugin is None:
+                        raise ValueError('no launcher plugin')
+                    host = element.find('host')
+                    port = element.find('port')
+                    launcher = (plugin,
+                                None if host is None else _simple_text(host),
+                                None if port is None else _simple_text(port))
+                elif element.tag == 'temporaryOfflineCause':
+                    temporary_offline = True
+
+                # Nothing before this element is needed anymore
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+            elif element.tag == 'tree-map' and env_vars is None and _is_env_vars(element):
+                num_properties = element.find('int')
+                env_vars = [_simple_text(value) for value in element.iterchildren('string')]
+                if num_properties is None:
+                    env_vars = None
+                else:
+                    num_properties = int(_simple_text(num_properties))
+                    if len(env_vars) < num_properties * 2:
+                        raise ValueError('missing environment variables')
+                    env_vars = env_vars[:num_properties * 2]
+                element.clear()
+    except etree.XMLSyntaxError as e:
+        raise ValueError(str(e))
+
+    if label is None:
+        raise ValueError('no label')
+    if launcher is None:
+        raise ValueError('no launcher')
+
+    node_properties = {}
+    for index in range(0, len(env_vars or []), 2):
+        if env_vars[index] not in FORBIDDEN_PROPERTIES:
+            node_properties[env_vars[index]] = env_vars[index + 1]
+
+    return ComputerRecord([name.strip() for name in label.strip().split(' ') if len(name) > 0],
+                          launcher[0], launcher[1], launcher[2], temporary_offline, node_properties, texts)
+
+
+# Filters and functions whose result changes between evaluations
+UNREPEATABLE_FILTERS = ('random', 'shuffle')
+UNREPEATABLE_CALLS = ('lookup', 'query', 'q', 'now')
+# Names that give the expression access to every variable
+ALL_VARIABLES_NAMES = ('vars', 'hostvars')
+
+
+def _expression_variables(expression, environment):
+    ''' Variables read by an expression, None if it can't be known. '''
+    if not isinstance(expression, str):
+        return set()
+
+    try:
+        ast = environment.parse(u'{{ ' + expression + u' }}')
+    except jinja2.TemplateSyntaxError:
+        try:
+            ast = environment.parse(expression)
+        except jinja2.TemplateSyntaxError:
+            return None
+
+    for node in ast.find_all(jinja2.nodes.Filter):
+        if node.name in UNREPEATABLE_FILTERS:
+            return None
+    for node in ast.find_all(jinja2.nodes.Call):
+        if isinstance(node.node, jinja2.nodes.Name) and node.node.name in UNREPEATABLE_CALLS:
+            return None
+
+    # Every name read, the ones set inside the expression too. The ansible filters
+    # are unknown here, so jinja2.meta.find_undeclared_variables can't be used.
+    variables = set(node.name for node in ast.find_all(jinja2.nodes.Name) if node.ctx == 'load')
+    if variables.intersection(ALL_VARIABLES_NAMES):
+        return None
+    return variables
+
+
+def constructed_variables(compose, groups, keyed_groups):
+    ''' Host variables read by the compose, groups and keyed_groups expressions.
+
+        The expressions are parsed just once per run. None is returned when
+        two hosts with the same values for these variables could get different
+        results, so every host has to be evaluated.
+    '''
+    environment = jinja2.Environment()
+    expressions = list((compose or {}).values()) + list((groups or {}).values())
+    for keyed in (keyed_groups or []):
+        if isinstance(keyed, dict):
+            expressions += [keyed.get('key'), keyed.get('parent_group')]
+
+    variables = set()
+    for expression in expressions:
+        expression_variables = _expression_variables(expression, environment)
+        if expression_variables is None:
+            return None
+        variables.update(expression_variables)
+    return variables
+
+
+class RecordingInventory(object):
+    ''' Inventory wrapper that records the changes done to one host.
+
+        The recorded changes are applied to other hosts with replay.
+    '''
+
+    def __init__(self, inventory, host):
+        self._inventory = inventory
+        self._host = host
+        self.changes = []
+
+    def __getattr__(self, name):
+        return getattr(self._inventory, name)
+
+    def _target(self, name):
+        # The host itself is recorded as None, so it can be replaced
+        return None if name == self._host else name
+
+    def set_variable(self, entity, varname, value):
+        self.changes.append(('set_variable', self._target(entity), varname, value))
+        return self._inventory.set_variable(entity, varname, value)
+
+    def add_group(self, group):
+        self.changes.append(('add_group', group))
+        return self._inventory.add_group(group)
+
+    def add_child(self, group, child):
+        self.changes.append(('add_child', group, self._target(child)))
+        return self._inventory.add_child(group, child)
+
+    def add_host(self, host, group=None, port=None):
+        self.changes.append(('add_host', self._target(host), group, port))
+        return self._inventory.add_host(host, group, port)
+
+    def replay(self, host):
+        ''' Does the recorded changes to another host. '''
+        def target(name):
+            return host if name is None else name
+
+        for change in self.changes:
+            if change[0] == 'set_variable':
+                self._inventory.set_variable(target(change[1]), change[2], copy.deepcopy(change[3]))
+            elif change[0] == 'add_group':
+                self._inventory.add_group(change[1])
+            elif change[0] == 'add_child':
+                self._inventory.add_child(change[1], target(change[2]))
+            else:
+                self._inventory.add_host(target(change[1]), change[2], change[3])
+
+
+# Phases of a parse, in the order they happen
+METRICS_PHASES = ('parse', 'login', 'listing', 'fetch', 'xml_parse', 'inventory', 'compose')
+METRICS_COUNTERS = ('requests', 'bytes', 'retries', 'cache_hits', 'cache_misses',
+                    'node_cache_hits', 'node_cache_misses')
+SLOWEST_NODES = 10
+
+
+class RunMetrics(object):
+    ''' Timers and counters of a parse, shared by every thread.
+
+        The time of a phase is the sum of every call, so xml_parse, done by
+        several threads at once, can be longer than the fetch it is part of.
+    '''
+
+    def __init__(self):
+        self.timestamp = time.time()
+        self.phases = dict((phase, 0.0) for phase in METRICS_PHASES)
+        self.counters = dict((counter, 0) for counter in METRICS_COUNTERS)
+        self.nodes = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def node_time(self, computer_name, seconds):
+        with self._lock:
+            self.nodes[computer_name] = self.nodes.get(computer_name, 0.0) + seconds
+
+    def slowest_nodes(self, count=SLOWEST_NODES):
+        return heapq.nlargest(count, self.nodes.items(), key=lambda node: node[1])
+
+    def to_dict(self):
+        return {'timestamp': self.timestamp,
+                'phases': self.phases,
+                'counters': self.counters,
+                'nodes': len(self.nodes),
+                'slowest_nodes': self.slowest_nodes()}
+
+    def summary(self):
+        timings = ', '.join('{0} {1:.3f}s'.format(phase, seconds) for phase, seconds in self.phases.items())
+        counters = ', '.join('{0} {1}'.format(counter, value) for counter, value in self.counters.items())
+        lines = ['Jenkins inventory timings: {0}'.format(timings),
+                 'Jenkins inventory counters: {0}'.format(counters)]
+
+        slowest = self.slowest_nodes()
+        if slowest:
+            nodes = ', '.join('{0} {1:.3f}s'.format(name, seconds) for name, seconds in slowest)
+            lines.append('Jenkins inventory slowest nodes: {0}'.format(nodes))
+        return lines
+
+
+# Bump it whenever the compact cache layout changes, caches with any
+#  other version are read again from jenkins
+CACHE_SCHEMA_VERSION = 1
+CACHE_FORMAT_KEY = 'jenkins_inventory_cache'
+
+
+class CompactData(object):
+    ''' Inventory data decoded from a compact cache.
+
+        strings: every string of the data, stored once.
+        shapes: lists of variable names (indexes in strings) shared by hosts.
+        hosts: [name, shape, value...] lists, a value is the index of a string,
+            or any other value wrapped in a list.
+        groups: [name, [host indexes]] lists, in the order of the data.
+    '''
+
+    def __init__(self, strings, shapes, hosts, groups):
+        self.strings = strings
+        self.shapes = shapes
+        self.hosts = hosts
+        self.groups = groups
+
+    def host_name(self, host_index):
+        return self.strings[self.hosts[host_index][0]]
+
+    def host_vars(self, host_index):
+        host = self.hosts[host_index]
+        strings = self.strings
+        return dict((strings[name], strings[value] if isinstance(value, int) else value[0])
+                    for name, value in zip(self.shapes[host[1]], host[2:]))
+
+    def to_data(self):
+        ''' Inventory data, as jenkins was read. '''
+        data = {'_meta': {'hostvars': dict((self.host_name(host_index), self.host_vars(host_index))
+                                           for host_index in range(len(self.hosts)))},
+                'all': {'children': ['ungrouped'], 'hosts': [], 'vars': {}}}
+        for group_index, host_indexes in self.groups:
+            group = self.strings[group_index]
+            if group != '_meta':
+                data[group] = {'children': [],
+                               'hosts': [self.host_name(host_index) for host_index in host_indexes],
+                               'vars': {}}
+                if group not in data['all']['children']:
+                    data['all']['children'].append(group)
+        return data
+
+
+def encode_compact_data(data):
+    ''' Compact cache payload of the inventory data, see CompactData. '''
+    strings = []
+    string_indexes = {}
+
+    def intern(text):
+        index = string_indexes.get(text)
+        if index is None:
+            index = string_indexes[text] = len(strings)
+            strings.append(text)
+        return index
+
+    shapes = []
+    shape_indexes = {}
+    hosts = []
+    host_indexes = {}
+    groups = []
+    hostvars = data.get('_meta', {}).get('hostvars', {})
+    for group in data:
+        if group == 'all':
+            continue
+        members = []
+        for host in data[group].get('hosts', []):
+            host_index = host_indexes.get(host)
+            if host_index is None:
+                host_vars = hostvars.get(host, {})
+                shape = tuple(intern(name) for name in host_vars)
+                shape_index = shape_indexes.get(shape)
+                if shape_index is None:
+                    shape_index = shape_indexes[shape] = len(shapes)
+                    shapes.append(shape)
+                values = [intern(value) if isinstance(value, str) else [value] for value in host_vars.values()]
+                host_index = host_indexes[host] = len(hosts)
+                hosts.append([intern(host), shape_index] + values)
+            members.append(host_index)
+        groups.append([intern(group), members])
+
+    compact = json.dumps({'strings': strings, 'shapes': shapes, 'hosts': hosts, 'groups': groups},
+                         separators=(',', ':'))
+    return {CACHE_FORMAT_KEY: CACHE_SCHEMA_VERSION,
+            'encoding': 'zlib+json',
+            'data': base64.b64encode(zlib.compress(compact.encode('utf-8'))).decode('ascii')}
+
+
+def decode_compact_data(cached):
+    ''' CompactData of a cache payload, None if it has another format or schema. '''
+    if not isinstance(cached, dict) or cached.get(CACHE_FORMAT_KEY) != CACHE_SCHEMA_VERSION:
+        return None
+    compact = json.loads(zlib.decompress(base64.b64decode(cached['data'])).decode('utf-8'))
+    return CompactData(compact['strings'], compact['shapes'], compact['hosts'], compact['groups'])
+
+
+# First line of a snapshot, followed by the lengths of the index and the groups
+SNAPSHOT_MAGIC = b'jenkins-inventory-snapshot'
+SNAPSHOT_VERSION = 1
+
+
+@contextmanager
+def write_private_file(path, mode='w'):
+    ''' File only we can read, written aside and put in place of path at once when it is closed. '''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, mode) as private_file:
+            yield private_file
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    # Readers see either the old file or the new one, never half of it
+    os.rename(tmp_path, path)
+
+
+def write_snapshot(path, data):
+    ''' Writes the inventory data to a snapshot file, replacing the old one at once.
+
+        Layout: a header line, the index (json object of host: [offset, length]),
+        the groups (json) and the json variables of every host. The offsets
+        start after the groups, so a host is read without decoding the rest.
+    '''
+    if isinstance(data, CompactData):
+        data = data.to_data()
+
+    hostvars = data.get('_meta', {}).get('hostvars', {})
+    hosts = list(hostvars)
+    host_indexes = dict((host, host_index) for host_index, host in enumerate(hosts))
+    groups = []
+    for group in data:
+        if group not in ('all', '_meta'):
+            members = []
+            for host in data[group].get('hosts', []):
+                if host not in host_indexes:
+                    host_indexes[host] = len(hosts)
+                    hosts.append(host)
+                members.append(host_indexes[host])
+            groups.append([group, members])
+
+    records = [json.dumps(hostvars.get(host, {}), separators=(',', ':')).encode('utf-8') for host in hosts]
+    index = {}
+    offset = 0
+    for host, record in zip(hosts, records):
+        index[host] = [offset, len(record)]
+        offset += len(record)
+
+    index_json = json.dumps(index, separators=(',', ':')).encode('utf-8')
+    groups_json = json.dumps({'children': data.get('all', {}).get('children', []), 'groups': groups},
+                             separators=(',', ':')).encode('utf-8')
+
+    # The variables of the computers could be secrets
+    with write_private_file(path, 'wb') as snapshot_file:
+        header = ' {0} {1} {2}\n'.format(SNAPSHOT_VERSION, len(index_json), len(groups_json))
+        snapshot_file.write(SNAPSHOT_MAGIC + header.encode('ascii'))
+        snapshot_file.write(index_json)
+        snapshot_file.write(groups_json)
+        for record in records:
+            snapshot_file.write(record)
+
+
+def _read_snapshot_header(path, snapshot):
+    # (index start, groups start, records start)
+    header = snapshot.readline().split()
+    if len(header) != 4 or header[0] != SNAPSHOT_MAGIC or header[1] != str(SNAPSHOT_VERSION).encode('ascii'):
+        raise AnsibleError('{0} is not a jenkins inventory snapshot of version {1}'.format(path, SNAPSHOT_VERSION))
+    index_start = snapshot.tell()
+    groups_start = index_start + int(header[2])
+    return index_start, groups_start, groups_start + int(header[3])
+
+
+def read_snapshot(path):
+    ''' Inventory data of a snapshot file. '''
+    with open(path, 'rb') as snapshot:
+        index_start, groups_start, records_start = _read_snapshot_header(path, snapshot)
+        index = json.loads(snapshot.read(groups_start - index_start).decode('utf-8'))
+        groups = json.loads(snapshot.read(records_start - groups_start).decode('utf-8'))
+        records = snapshot.read()
+
+    data = {'_meta': {'hostvars': {}},
+            'all': {'children': groups['children'], 'hosts': [], 'vars': {}}}
+    hostvars = data['_meta']['hostvars']
+    hosts = list(index)
+    for host in hosts:
+        offset, length = index[host]
+        hostvars[host] = json.loads(records[offset:offset + length].decode('utf-8'))
+    for group, members in groups['groups']:
+        data[group] = {'children': [], 'hosts': [hosts[member] for member in members], 'vars': {}}
+    return data
+
+
+def read_snapshot_host(path, host):
+    ''' Variables of a host of a snapshot file, None if it is not there.
+
+        The file is memory mapped: only the header, the index and the
+        variables of the host are read.
+    '''
+    with open(path, 'rb') as snapshot_file:
+        with closing(mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)) as snapshot:
+            index_start, groups_start, records_start = _read_snapshot_header(path, snapshot)
+            index = json.loads(snapshot[index_start:groups_start].decode('utf-8'))
+            if host not in index:
+                return None
+            offset, length = index[host]
+            start = records_start + offset
+            return json.loads(snapshot[start:start + length].decode('utf-8'))
+
+
+class JenkinsHTTPError(AnsibleError):
+    ''' Jenkins answered a request with an error status. '''
+
+    def __init__(self, url, status, reason, headers=None):
+        super(JenkinsHTTPError, self).__init__('HTTP Error {0}: {1} ({2})'.format(status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+
+class JenkinsResponse(object):
+    ''' Already read answer of a request done through a JenkinsSession. '''
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+# Answers of an overloaded jenkins (or of the proxy in front of it)
+RETRY_STATUS = (429, 502, 503, 504)
+RETRY_BACKOFF = 0.5
+RETRY_MAX_DELAY = 30
+# Redirections of the GET requests followed, jenkins moved to https for example
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+def must_retry(method, response, error, retry_timeouts=False):
+    # A POST could be done twice (scriptText runs the whole script again)
+    if method != 'GET':
+        return False
+    if isinstance(error, socket.timeout):
+        return retry_timeouts
+    return error is not None or response.status in RETRY_STATUS
+
+
+def retry_delay(attempt, response=None):
+    ''' Exponential backoff with full jitter, or what jenkins asked for in Retry-After. '''
+    try:
+        delay = float(response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        delay = random.uniform(0, RETRY_BACKOFF * (2 ** attempt))
+
+    return min(delay, RETRY_MAX_DELAY)
+
+
+class AIMDLimiter(object):
+    ''' Number of requests allowed at the same time.
+
+        If adaptive, it grows while jenkins answers within the target
+        latency, one more request per answer until the first slow one
+        and then one more per "limit" answers (additive increase), and it
+        is halved when an answer is slow, or an error (429, 503, no
+        connection...), at most once per target latency (multiplicative
+        decrease). It never goes under 1 nor over max_limit. If not
+        adaptive, it's always max_limit.
+    '''
+
+    def __init__(self, max_limit, adaptive=False, target_latency=1.0):
+        self.max_limit = max(1, max_limit)
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.limit = 1.0 if adaptive else float(self.max_limit)
+        self.in_flight = 0
+        self._slow_start = True
+        self._last_decrease = 0.0
+
+    def _can_start(self):
+        return self.in_flight < int(self.limit)
+
+    def _update(self, latency, ok):
+        if not self.adaptive:
+            return
+
+        now = time.time()
+        if not ok or latency > self.target_latency:
+            self._slow_start = False
+            if now - self._last_decrease >= self.target_latency:
+                self._last_decrease = now
+                self.limit = max(1.0, self.limit / 2)
+                display.vvvv('Jenkins is struggling, {0} requests at the same time'.format(int(self.limit)))
+        elif self._slow_start:
+            self.limit = min(float(self.max_limit), self.limit + 1)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+
+class AdaptiveLimiter(AIMDLimiter):
+    ''' AIMDLimiter for threads. '''
+
+    def __init__(self, *args, **kwargs):
+        super(AdaptiveLimiter, self).__init__(*args, **kwargs)
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while not self._can_start():
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self._condition:
+            self.in_flight -= 1
+            self._update(latency, ok)
+            self._condition.notify_all()
+
+
+class AsyncAdaptiveLimiter(AIMDLimiter):
+    ''' AIMDLimiter for coroutines, it must be built inside the event loop. '''
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncAdaptiveLimiter, self).__init__(*args, **kwargs)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(self._can_start)
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        self.in_flight -= 1
+        self._update(latency, ok)
+        # Wake up the waiting requests from the event loop
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+
+class BaseJenkinsSession(object):
+    ''' Retries and answer checks of the requests to a jenkins instance.
+
+        The sessions only send the requests, every attempt is accounted
+        (metrics and limiter) and retried, the redirections of the GET
+        requests followed, and the final answer checked, the same way for
+        threads and coroutines.
+    '''
+
+    def __init__(self, jenkins_host, timeout=None, retries=0, limiter=None, metrics=None, deadline=None,
+                 retry_timeouts=False):
+        url = urlsplit(jenkins_host)
+        self.scheme = url.scheme or 'http'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.scheme == 'https' else 80)
+        self.base_path = url.path.rstrip('/')
+        # Ansible's open_url used 10 seconds when no timeout was given
+        self.timeout = timeout or 10
+        self.retries = retries
+        self.retry_timeouts = retry_timeouts
+        self.limiter = limiter
+        self.metrics = metrics
+        # time.time() when every request must be done, None if there is no hurry
+        self.deadline = deadline
+
+    def url(self, path):
+        return '{0}/{1}'.format(self.base_path, path.lstrip('/'))
+
+    def _attempt_timeout(self, url):
+        ''' Timeout of the next attempt, the time left before the deadline at most. '''
+        if self.deadline is None:
+            return self.timeout
+
+        time_left = self.deadline - time.time()
+        if time_left <= 0:
+            raise AnsibleError('Request to {0} failed: deadline exceeded'.format(url))
+        return min(self.timeout, time_left)
+
+    def _attempt_done(self, start, response):
+        if self.metrics is not None:
+            self.metrics.count('requests')
+            if response is not None:
+                self.metrics.count('bytes', len(response.body))
+        if self.limiter is not None:
+            self.limiter.release(time.time() - start,
+                                 response is not None and response.status not in RETRY_STATUS)
+
+    def _retry_delay(self, method, url, attempt, response, error):
+        ''' Seconds to wait before the next attempt, None if there is no need or no attempts left. '''
+        if not must_retry(method, response, error, self.retry_timeouts) or attempt == self.retries:
+            return None
+        delay = retry_delay(attempt, response)
+        if self.deadline is not None and time.time() + delay >= self.deadline:
+            display.vvv('Request to {0} failed ({1}), no time left to retry'.format(url, error or response.status))
+            return None
+        display.vvv('Request to {0} failed ({1}), retrying in {2:.2f} seconds'.format(url, error or response.status, delay))
+        if self.metrics is not None:
+            self.metrics.count('retries')
+        return delay
+
+    def _redirect_url(self, method, url, response, redirects):
+        ''' Url of the same jenkins a GET answer redirects to, None if it must not be followed. '''
+        if response is None or method != 'GET' or response.status not in REDIRECT_STATUS or redirects == MAX_REDIRECTS:
+            return None
+        location = response.headers.get('Location')
+        # The login page means the session is not valid, see _is_login_required
+        if not location or 'login' in location:
+            return None
+
+        target = urlsplit(urljoin('{0}://{1}:{2}{3}'.format(self.scheme, self.host, self.port, url), location))
+        # The credentials are never sent to another host
+        if target.hostname != self.host:
+            display.vvv('Request to {0} redirected to another host, not followed: {1}'.format(url, location))
+            return None
+
+        port = target.port or (443 if target.scheme == 'https' else 80)
+        if (target.scheme, port) != (self.scheme, self.port):
+            # Every request would be redirected the same way
+            display.vvv('Jenkins moved to {0}://{1}:{2}'.format(target.scheme, self.host, port))
+            self.close()
+            self.scheme = target.scheme
+            self.port = port
+        return target.path + ('?' + target.query if target.query else '')
+
+    def _checked_response(self, method, url, response, error):
+        if error is not None:
+            raise AnsibleError('Request to {0} failed: {1}'.format(url, error))
+
+        # Only the login redirection is expected, the others were followed.
+        #  "Not modified" is the answer to a conditional request, see node_cache
+        if response.status >= 400 or (response.status >= 300 and response.status != 304 and method != 'POST'):
+            raise JenkinsHTTPError(url, response.status, response.reason, response.headers)
+
+        return response
+
+
+class JenkinsSession(BaseJenkinsSession):
+    ''' Pool of keep-alive connections to a jenkins instance.
+
+        Every request of a parse goes through the same session, so the
+        TCP (and TLS) handshake is done once per connection instead of
+        once per request. It can be shared by several threads, each
+        request takes an idle connection from the pool, or opens a new
+        one if there is none, and gives it back once the answer is read.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(JenkinsSession, self).__init__(*args, **kwargs)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            # Certificates were never validated by this plugin
+            context = ssl._create_unverified_context()
+            return http_client.HTTPSConnection(self.host, self.port,
+                                               timeout=self.timeout,
+                                               context=context)
+        return http_client.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def _get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _release_connection(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def request(self, method, path, data=None, headers=None):
+        url = self.url(path)
+
+        for redirects in range(MAX_REDIRECTS + 1):
+            response, error = self._request_attempts(method, url, data, headers or {})
+            redirect_url = self._redirect_url(method, url, response, redirects)
+            if redirect_url is None:
+                return self._checked_response(method, url, response, error)
+            url = redirect_url
+
+    def _request_attempts(self, method, url, data, headers):
+        for attempt in range(self.retries + 1):
+            timeout = self._attempt_timeout(url)
+            if self.limiter is not None:
+                self.limiter.acquire()
+            start = time.time()
+            response = error = None
+            try:
+                response = self._send(method, url, data, headers, timeout)
+            except (http_client.HTTPException, socket.error) as e:
+                error = e
+            finally:
+                self._attempt_done(start, response)
+
+            delay = self._retry_delay(method, url, attempt, response, error)
+            if delay is None:
+                break
+            time.sleep(delay)
+
+        return response, error
+
+    def _send(self, method, url, data, headers, timeout):
+        while True:
+            connection, reused = self._get_connection()
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, url, body=data, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except socket.timeout:
+                # Slow, not closed: only retry_timeouts sends it again
+                connection.close()
+                raise
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                # jenkins (or a load balancer) may have closed an idle
+                #  connection, try again with a brand new one
+                if reused:
+                    continue
+                raise
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(connection)
+
+        return JenkinsResponse(url, response.status, response.reason, response.msg, body)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class AsyncJenkinsSession(BaseJenkinsSession):
+    ''' asyncio twin of JenkinsSession, for the async engine.
+
+        A tiny HTTP/1.1 client on top of asyncio streams: a single event
+        loop drives every request, with no thread per request. The limiter
+        decides how many requests (and keep-alive connections) are open at
+        the same time, and every request must be answered within the timeout.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncJenkinsSession, self).__init__(*args, **kwargs)
+        self._idle = []
+
+    async def _new_connection(self):
+        context = None
+        if self.scheme == 'https':
+            # Certificates were never validated by this plugin
+            context = ssl._create_unverified_context()
+        return await asyncio.open_connection(self.host, self.port, ssl=context)
+
+    async def request(self, method, path, data=None, headers=None):
+        url = self.url(path)
+
+        for redirects in range(MAX_REDIRECTS + 1):
+            response, error = await self._request_attempts(method, url, data, headers or {})
+            redirect_url = self._redirect_url(method, url, response, redirects)
+            if redirect_url is None:
+                return self._checked_response(method, url, response, error)
+            url = redirect_url
+
+    async def _request_attempts(self, method, url, data, headers):
+        for attempt in range(self.retries + 1):
+            timeout = self._attempt_timeout(url)
+            await self.limiter.acquire()
+            start = time.time()
+            response = error = None
+            try:
+                response = await self._send(method, url, data, headers, timeout)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+                error = e
+                if isinstance(e, asyncio.TimeoutError):
+                    # Same as the threads, see must_retry
+                    error = socket.timeout('timed out after {0:.2f} seconds'.format(timeout))
+            finally:
+                self._attempt_done(start, response)
+
+            delay = self._retry_delay(method, url, attempt, response, error)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        return response, error
+
+    async def _send(self, method, url, data, headers, timeout):
+        end = time.time() + timeout
+        while True:
+            reused = bool(self._idle)
+            connection = self._idle.pop() if reused else None
+            try:
+                if connection is None:
+                    connection = await asyncio.wait_for(self._new_connection(), max(0, end - time.time()))
+                response, keep_alive = await asyncio.wait_for(
+                    self._exchange(connection, method, url, data, headers), max(0, end - time.time()))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                if connection is not None:
+                    connection[1].close()
+                # jenkins (or a load balancer) may have closed an idle
+                #  connection, try again with a brand new one
+                if reused:
+                    continue
+                raise
+            except asyncio.TimeoutError:
+                if connection is not None:
+                    connection[1].close()
+                raise
+            break
+
+        if keep_alive:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+
+        return response
+
+    async def _exchange(self, connection, method, url, data, headers):
+        reader, writer = connection
+
+        host = self.host if self.port in (80, 443) else '{0}:{1}'.format(self.host, self.port)
+        lines = ['{0} {1} HTTP/1.1'.format(method, url), 'Host: {0}'.format(host)]
+        lines += ['{0}: {1}'.format(header, value) for header, value in headers.items()]
+        if data is not None:
+            lines.append('Content-Length: {0}'.format(len(data)))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b''))
+        await writer.drain()
+
+        status_line = (await reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+        version, status, reason = (status_line.split(' ', 2) + [''])[:3]
+        status = int(status)
+
+        header_lines = []
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            header_lines.append(line)
+        response_headers = Parser(_class=http_client.HTTPMessage).parsestr(b''.join(header_lines).decode('latin-1'))
+
+        keep_alive = version == 'HTTP/1.1' and (response_headers.get('Connection') or '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304):
+            body = b''
+        elif (response_headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+            body = await self._read_chunked(reader)
+        elif response_headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(response_headers['Content-Length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return JenkinsResponse(url, status, reason, response_headers, body), keep_alive
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0].strip(), 16)
+            if size == 0:
+                # Trailers, up to the empty line
+                while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for reader, writer in idle:
+            writer.close()
+
+
+# Options of the whole inventory, the masters can't set them
+INVENTORY_OPTIONS = ('masters', 'master_hosts', 'master_groups', 'label_groups', 'snapshot_path', 'metrics_file')
+
+
+@lru_cache(maxsize=None)
+def master_option_types():
+    ''' (type, choices) of every option a jenkins master can set, by name. '''
+    options = yaml.safe_load(DOCUMENTATION)['options']
+    option_types = dict((name, (option.get('type', 'string'), option.get('choices')))
+                        for name, option in options.items() if name not in INVENTORY_OPTIONS)
+    option_types['name'] = ('string', None)
+    return option_types
 
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
@@ -71,50 +1619,173 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
     NAME = 'jenkins'
 
+    cookie = None
+    _cookie_cached = False
+    _session = None
+    _node_cache = None
+    _interned_texts = None
+    _metrics = None
+    master_name = None
+    _deadline = None
+    _stale_computers = ()
+    _label_groups = None
+    # Groups of the inventory data that are not labels of its computers
+    _not_labels = frozenset(['ungrouped'])
+    # (variables used by the constructed options, RecordingInventory per values)
+    _composed = None
+
     def _do_login(self):
         display.vvv('Do login. Using jsessionid cookie.')
         login_url = 'j_acegi_security_check'
-        jenkins_url = '{0}/{1}'.format(self._get_jenkins_host(), login_url)
         data = urlencode({'j_username': self._get_jenkins_user(), 'j_password': self._get_jenkins_pass()}).encode("utf-8")
 
-        class SmartRedirectHandler(HTTPRedirectHandler):
-
-            def extract_cookie(self, setcookie):
-                # Extracts the last cookie.
-                # Example of set-cookie value for python2
-                # ('set-cookie', 'JSESSIONID.30blah=blahblahblah;Path=/;HttpOnly, JSESSIONID.30ablah=blahblah;Path=/;HttpOnly'),
-                return setcookie.split(',')[-1].split(';')[0].strip('\n\r ')
-
-            def http_error_302(self, req, fp, code, msg, headers):
-                # Jenkins can send several Set-Cookie values sometimes
-                #  The valid one is the last one
-                for header, value in headers.items():
-                    if header.lower() == 'set-cookie':
-                        cookie = self.extract_cookie(value)
-
-                req.headers['Cookie'] = cookie
-                result = HTTPRedirectHandler.http_error_302(self, req, fp,
-                                                            code, msg,
-                                                            headers)
-                result.orig_status = code
-                result.orig_headers = headers
-                result.cookie = cookie
-                return result
-
-        request = Request(jenkins_url, data)
-        opener = build_opener(SmartRedirectHandler())
-        res = opener.open(request)
-        self._save_cookie(res.cookie)
+        # The session does not follow the redirect of a POST, so we can take the
+        #  cookie straight from the login answer
+        with self._get_metrics().phase('login'):
+            res = self._get_session().request('POST', login_url, data=data,
+                                              headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        self._save_cookie(self._extract_cookie(res.headers))
+
+    def _extract_cookie(self, headers):
+        # Jenkins can send several Set-Cookie values sometimes
+        #  The valid one is the last one
+        cookie = None
+        for setcookie in headers.get_all('Set-Cookie') or []:
+            # Extracts the last cookie.
+            # Example of a joined set-cookie value
+            # ('set-cookie', 'JSESSIONID.30blah=blahblahblah;Path=/;HttpOnly, JSESSIONID.30ablah=blahblah;Path=/;HttpOnly'),
+            cookie = setcookie.split(',')[-1].split(';')[0].strip('\n\r ')
+
+        if cookie is None:
+            raise AnsibleError('Jenkins did not send the jsessionid cookie when login in {0}'.format(self._get_jenkins_host()))
+
+        return cookie
+
+    def _get_session(self):
+        if self._session is None:
+            limiter = None
+            if self._options.get('adaptive_concurrency', False):
+                limiter = AdaptiveLimiter(self._options.get('max_workers', 1) or 1, adaptive=True,
+                                          target_latency=self._options.get('target_latency', 1.0))
+            self._session = JenkinsSession(self._get_jenkins_host(),
+                                           timeout=self._options.get('timeout', None),
+                                           retries=self._options.get('retries', 0),
+                                           retry_timeouts=self._options.get('retry_timeouts', False),
+                                           limiter=limiter,
+                                           metrics=self._get_metrics(),
+                                           deadline=self._deadline)
+        return self._session
+
+    def _get_metrics(self):
+        if self._metrics is None:
+            self._metrics = RunMetrics()
+        return self._metrics
+
+    def _report_metrics(self):
+        metrics = self._get_metrics()
+        for line in metrics.summary():
+            display.vvv(line)
+
+        metrics_file = self._options.get('metrics_file', None)
+        if metrics_file:
+            run = metrics.to_dict()
+            run['jenkins_host'] = self._options.get('jenkins_host', None)
+            try:
+                with open(os.path.expanduser(metrics_file), 'a') as f:
+                    f.write(json.dumps(run, sort_keys=True) + '\n')
+            except (IOError, OSError) as e:
+                display.warning('Could not write the jenkins inventory metrics to {0}: {1}'.format(metrics_file, e))
+
+    def _close_session(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _get_state_file(self, prefix, key=None, extension='json'):
+        # One file per jenkins instance and user, since each user could
+        #  see different computers
+        state_id = '{0}|{1}|{2}'.format(self._get_jenkins_host(), self._get_jenkins_user(), key or '')
+        digest = hashlib.sha1(state_id.encode('utf-8')).hexdigest()[:16]
+        state_dir = os.path.expanduser(self._options.get('state_dir', None) or DEFAULT_STATE_DIR)
+        return os.path.join(state_dir, '{0}_{1}.{2}'.format(prefix, digest, extension))
+
+    def _read_state(self, path):
+        try:
+            with open(path, 'r') as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError) as e:
+            display.vvvv('Could not read state file {0}: {1}'.format(path, e))
+            return None
+
+    def _write_state(self, path, state):
+        # Nobody but us should read those files, they could contain secrets
+        with write_private_file(path) as state_file:
+            json.dump(state, state_file)
+
+    def _load_node_cache(self):
+        self._new_node_cache = {}
+        # The deadline needs the last data known of every computer
+        if not (self._options.get('node_cache', False) or self._options.get('deadline', None)):
+            self._node_cache = None
+            return
+
+        self._node_cache = self._read_state(self._get_state_file('nodes')) or {}
+        for entry in self._node_cache.values():
+            entry['record'] = ComputerRecord.from_state(entry['record'], self._interned_texts)
+        display.vvv('Node cache loaded with {0} computers'.format(len(self._node_cache)))
+
+    def _save_node_cache(self):
+        if self._node_cache is None:
+            return
+
+        # Requests left behind by the deadline could still be adding computers
+        self._write_state(self._get_state_file('nodes'),
+                          dict((computer_name, dict(entry, record=entry['record'].to_state()))
+                               for computer_name, entry in list(self._new_node_cache.items())))
 
     def _save_cookie(self, cookie):
         self.cookie = cookie
+        self._cookie_cached = False
+
+        if self._options.get('jsessionid_cache', False):
+            self._write_state(self._get_state_file('session'), {'cookie': cookie, 'timestamp': time.time()})
+
+    def _load_cookie(self):
+        if not self._options.get('jsessionid_cache', False):
+            return False
+
+        session = self._read_state(self._get_state_file('session'))
+        if session is None:
+            return False
+
+        age = time.time() - session.get('timestamp', 0)
+        if not 0 <= age < self._options.get('jsessionid_ttl', 1800):
+            display.vvv('The cached jsessionid is too old ({0:.0f} seconds).'.format(age))
+            return False
+
+        display.vvv('Using the cached jsessionid, {0:.0f} seconds old.'.format(age))
+        self.cookie = session['cookie']
+        self._cookie_cached = True
+        return True
 
     def parse(self, inventory, loader, path, cache=True):
+        self._metrics = RunMetrics()
+        try:
+            with self._metrics.phase('parse'):
+                self._parse(inventory, loader, path, cache)
+        finally:
+            self._report_metrics()
+
+    def _parse(self, inventory, loader, path, cache):
 
         super(InventoryModule, self).parse(inventory, loader, path)
 
         # Load the configuration data from jenkins inventory file.
         self._read_config_data(path)
+        self._composed = None
+        # Matched when the hosts are added, so the cached data has only
+        #  the labels and is still right if the expressions change
+        self._label_groups = LabelGroups(self._options.get('label_groups', None))
 
         # false when refresh_cache or --flush-cache is used
         if cache:
@@ -125,116 +1796,729 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             cache_key = None
 
         # Generate inventory
+        if self._options.get('snapshot_path', None):
+            # Jenkins is read by somebody else, see main()
+            data = read_snapshot(self._options['snapshot_path'])
+        elif self._options.get('masters', None):
+            data = self._get_masters_data(cache, cache_key)
+        else:
+            data = self._read_cache(cache, cache_key)
+            if data is None:
+                # Every computer is added to the inventory, and its composed
+                #  variables and groups evaluated, while the next ones are read
+                self._inventory_groups = set()
+                data = self.get_data_from_jenkins(on_computer=self._add_computer_2_inventory)
+                self._write_cache(cache, cache_key, data)
+                return
+
+        with self._get_metrics().phase('inventory'):
+            self._data_2_inventory(data)
+        with self._get_metrics().phase('compose'):
+            self._add_composed_hostvars()
+
+    def _read_cache(self, cache, cache_key):
+        ''' Cached data, or stale data being refreshed, None if jenkins must be read. '''
         cache_needs_update = False
+        data = None
         if cache:
             try:
-                data = self.cache.get(cache_key)
+                data = self._get_cached_data(cache_key)
+                self._get_metrics().count('cache_hits')
             except KeyError:
                 # if cache expires or cache file doesn't exist
                 cache_needs_update = True
+                self._get_metrics().count('cache_misses')
 
         display.vvv('Cache {0}. Needs update {1}. Cache key {2}'.format(cache,
                                                                         cache_needs_update,
                                                                         cache_key))
 
-        if not cache or cache_needs_update:
-            data = self.get_data_from_jenkins()
+        if cache_needs_update and self._options.get('cache_mode', 'default') == 'stale_while_revalidate':
+            data = self._get_stale_data(cache_key)
+            if data is not None:
+                # Somebody else will update the cache
+                self._refresh_in_background(cache_key)
+
+        return data
+
+    def _write_cache(self, cache, cache_key, data):
+        if cache and self._stale_computers:
+            display.vvv('Not caching an inventory with stale computers.')
+        elif cache:
+            self._set_cached_data(cache_key, data)
+            if self._options.get('cache_mode', 'default') == 'stale_while_revalidate':
+                self._save_stale_data(cache_key, data)
+
+    def _get_master_plugins(self):
+        plugins = []
+        for master in self._options.get('masters', None) or []:
+            if not isinstance(master, dict) or not master.get('jenkins_host'):
+                raise AnsibleError('Every jenkins master needs its jenkins_host: {0}'.format(master))
+
+            plugin = InventoryModule()
+            plugin._options = dict(self._options, masters=None)
+            plugin._options.update(self._get_master_options(master))
+            plugin.master_name = master.get('name') or urlsplit(master['jenkins_host']).hostname
+            plugin._cache = getattr(self, '_cache', None)
+            plugin._metrics = self._get_metrics()
+            plugins.append(plugin)
+
+        names = [plugin.master_name for plugin in plugins]
+        if len(set(names)) != len(names):
+            raise AnsibleError('The jenkins masters must have different names: {0}'.format(', '.join(names)))
+
+        return plugins
+
+    def _get_master_options(self, master):
+        # Validated and converted as ansible does with the options of the
+        #  inventory file, "timeout: '30'" is 30
+        option_types = master_option_types()
+        options = {}
+        for option, value in master.items():
+            if option not in option_types:
+                raise AnsibleError('Unknown option {0} of the jenkins master {1}. Valid options: {2}'.format(
+                    option, master['jenkins_host'], ', '.join(sorted(option_types))))
+
+            option_type, choices = option_types[option]
+            try:
+                value = ensure_type(value, option_type)
+            except (TypeError, ValueError) as e:
+                raise AnsibleError('Invalid {0} of the jenkins master {1}: {2}'.format(option, master['jenkins_host'], e))
+            if choices and value not in choices:
+                raise AnsibleError('Invalid {0} of the jenkins master {1}: {2}, it must be one of {3}'.format(
+                    option, master['jenkins_host'], value, ', '.join(choices)))
+            options[option] = value
+
+        return options
+
+    def _get_master_cache_key(self, cache_key):
+        # One entry per master, so each one expires on its own
+        if cache_key is None:
+            return None
+        master_id = '{0}|{1}'.format(self._get_jenkins_host(), self._get_jenkins_user())
+        return '{0}_{1}'.format(cache_key, hashlib.sha1(master_id.encode('utf-8')).hexdigest()[:8])
+
+    def _get_masters_data(self, cache=False, cache_key=None):
+        plugins = self._get_master_plugins()
+
+        # The cache is read here, any background refresh is forked
+        #  before starting the threads
+        masters_data = [plugin._read_cache(cache, plugin._get_master_cache_key(cache_key)) for plugin in plugins]
+        pending = [index for index, data in enumerate(masters_data) if data is None]
+
+        if pending:
+            # Nobody could tell which thread asks for its password
+            for index in pending:
+                plugins[index]._get_jenkins_pass()
+
+            errors = []
+            with concurrent_futures.ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = [executor.submit(plugins[index].get_data_from_jenkins) for index in pending]
+            for index, future in zip(pending, futures):
+                plugin = plugins[index]
+                try:
+                    masters_data[index] = future.result()
+                except Exception as e:
+                    errors.append('{0}: {1}'.format(plugin.master_name, e))
+                    continue
+                # The masters read are cached even if another one failed
+                plugin._write_cache(cache, plugin._get_master_cache_key(cache_key), masters_data[index])
+
+            if errors:
+                raise AnsibleError('Could not read the jenkins masters. {0}'.format('. '.join(errors)))
+
+        return self._merge_masters_data(plugins, masters_data)
+
+    def _merge_masters_data(self, plugins, masters_data):
+        data = self._init_empty_inventory()
+        hostvars = data['_meta']['hostvars']
+        children = set(data['all']['children'])
+        group_hosts = {}
+        prefix_hosts = self._options.get('master_hosts', 'keep') == 'prefix'
+
+        def add_to_group(group, host):
+            if group not in data:
+                data[group] = self._get_empty_group()
+                group_hosts[group] = set()
+            if host not in group_hosts[group]:
+                group_hosts[group].add(host)
+                data[group]['hosts'].append(host)
+            if group not in children:
+                children.add(group)
+                data['all']['children'].append(group)
+
+        master_names = [plugin.master_name for plugin in plugins] if self._options.get('master_groups', False) else []
+        self._not_labels = InventoryModule._not_labels.union(master_names)
 
-        self._data_2_inventory(data)
-        self._add_composed_hostvars()
+        for plugin, master_data in zip(plugins, masters_data):
+            if isinstance(master_data, CompactData):
+                master_data = master_data.to_data()
+            name = plugin.master_name
 
-        if cache_needs_update:
+            def host_name(computer_name):
+                return '{0}_{1}'.format(name, computer_name) if prefix_hosts else computer_name
+
+            for computer_name, host_vars in master_data['_meta']['hostvars'].items():
+                host = host_name(computer_name)
+                if self._options.get('master_groups', False):
+                    add_to_group(name, host)
+                if host in hostvars:
+                    display.warning('Computer {0} of jenkins master {1} is in another master too, '
+                                    'keeping the variables of the first one.'.format(computer_name, name))
+                    continue
+                hostvars[host] = dict(host_vars, jenkins_master=name)
+
+            for group, group_data in master_data.items():
+                if group not in ('all', '_meta'):
+                    for computer_name in group_data.get('hosts', []):
+                        add_to_group(group, host_name(computer_name))
+
+        return data
+
+    def _get_cached_data(self, cache_key):
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            # The cache of the current ansible versions doesn't raise
+            #  KeyError when the key is missing or expired
+            raise KeyError(cache_key)
+        compact = decode_compact_data(cached)
+
+        if self._options.get('cache_format', 'json') == 'compact':
+            if compact is None:
+                display.vvv('Cache written with another format or schema, reading jenkins again.')
+                raise KeyError(cache_key)
+            return compact
+
+        if isinstance(cached, dict) and CACHE_FORMAT_KEY in cached:
+            display.vvv('Cache written with the compact format, reading jenkins again.')
+            raise KeyError(cache_key)
+        return cached
+
+    def _set_cached_data(self, cache_key, data):
+        if self._options.get('cache_format', 'json') == 'compact':
+            data = encode_compact_data(data)
+        if hasattr(self.cache, 'set'):
+            # Cache plugin of the older ansible versions
             self.cache.set(cache_key, data)
+        else:
+            self.cache[cache_key] = data
+            # Written now, the background refresh never goes back to ansible
+            self.cache.update_cache_if_changed()
+
+    def _get_stale_data(self, cache_key):
+        stale = self._read_state(self._get_state_file('stale', cache_key))
+        if stale is None:
+            return None
+
+        age = time.time() - stale.get('timestamp', 0)
+        if age > self._options.get('max_stale', 86400):
+            display.vvv('Stale inventory too old ({0:.0f} seconds), waiting for jenkins.'.format(age))
+            return None
+
+        display.vvv('Using the inventory read {0:.0f} seconds ago, refreshing it in the background.'.format(age))
+        return stale['data']
+
+    def _save_stale_data(self, cache_key, data):
+        self._write_state(self._get_state_file('stale', cache_key), {'timestamp': time.time(), 'data': data})
+
+    def _refresh_in_background(self, cache_key):
+        lock_path = self._get_state_file('stale', cache_key, extension='lock')
+        if not os.path.isdir(os.path.dirname(lock_path)):
+            os.makedirs(os.path.dirname(lock_path), 0o700)
+
+        # Only one refresh at a time, the lock is held by the refresh
+        #  process until it finishes
+        lock_fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(lock_fd)
+            display.vvv('The inventory is already being refreshed.')
+            return
+
+        # Ask for the password now, nobody will answer the refresh process
+        self._get_jenkins_pass()
+
+        if os.fork() != 0:
+            os.close(lock_fd)
+            return
+
+        # Refresh process, detached from this ansible run
+        status = 1
+        try:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
 
-    def _add_composed_hostvars(self):
+            data = self.get_data_from_jenkins()
+            self._set_cached_data(cache_key, data)
+            self._save_stale_data(cache_key, data)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def _add_composed_hostvars(self, hostnames=None):
+        # hostnames: the hosts just added, every host of the inventory if None
         strict = self._options.get('strict', False)
-
-        for hostname in self.inventory.hosts:
+        compose = self._options.get('compose')
+        groups = self._options.get('groups')
+        keyed_groups = self._options.get('keyed_groups')
+        if not (compose or groups or keyed_groups):
+            return
+
+        # Hosts with the same values for the variables used in the expressions
+        # get the same variables and groups, evaluate them once per values
+        if self._composed is None:
+            self._composed = (constructed_variables(compose, groups, keyed_groups), {})
+        variables, recorded = self._composed
+
+        for hostname in self.inventory.hosts if hostnames is None else hostnames:
             host = self.inventory.get_host(hostname)
             hostvars = host.vars
-            # Composed variables
-            if self._options.get('compose'):
-                # create composite vars
-                self._set_composite_vars(self.get_option('compose'), hostvars, hostname, strict=strict)
-
-            # Complex groups based on jinaj2 conditionals, hosts that meet the conditional are added to group
-            if self._options.get('groups'):
-                # constructed groups based on conditionals
-                self._add_host_to_composed_groups(self.get_option('groups'), hostvars, hostname, strict=strict)
+            if variables is None:
+                self._add_composed_host(hostvars, hostname, strict)
+                continue
 
-            # Create groups based on variable values and add the corresponding hosts to it
-            if self._options.get('keyed_groups'):
-                self._add_host_to_keyed_groups(self.get_option('keyed_groups'), hostvars, hostname, strict=strict)
+            key = self._get_composed_key(host, variables)
+            if key in recorded:
+                recorded[key].replay(hostname)
+                continue
 
-    def get_data_from_jenkins(self):
+            inventory = self.inventory
+            recording = RecordingInventory(inventory, hostname)
+            self.inventory = recording
+            try:
+                self._add_composed_host(hostvars, hostname, strict)
+            finally:
+                self.inventory = inventory
+            recorded[key] = recording
+
+    def _get_composed_key(self, host, variables):
+        host_vars = host.get_vars()
+        return json.dumps(dict((name, host_vars.get(name)) for name in variables if name in host_vars),
+                          sort_keys=True, default=repr)
+
+    def _add_composed_host(self, hostvars, hostname, strict):
+        # Composed variables
+        if self._options.get('compose'):
+            # create composite vars
+            self._set_composite_vars(self.get_option('compose'), hostvars, hostname, strict=strict)
+
+        # Complex groups based on jinaj2 conditionals, hosts that meet the conditional are added to group
+        if self._options.get('groups'):
+            # constructed groups based on conditionals
+            self._add_host_to_composed_groups(self.get_option('groups'), hostvars, hostname, strict=strict)
+
+        # Create groups based on variable values and add the corresponding hosts to it
+        if self._options.get('keyed_groups'):
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), hostvars, hostname, strict=strict)
+
+    def get_data_from_jenkins(self, on_computer=None):
+        ''' on_computer(computer_name, groups, data) is called for every computer, in listing order,
+            as soon as it is merged in the data. It is not called reading several masters. '''
+        if self._options.get('masters', None):
+            return self._get_masters_data()
+
+        try:
+            return self._get_data_from_jenkins(on_computer)
+        finally:
+            self._close_session()
+            # The requests left behind by the deadline don't get it
+            self._interned_texts = None
+
+    def _get_data_from_jenkins(self, on_computer=None):
+        self._cookie_cached = False
+        deadline = self._options.get('deadline', None)
+        self._deadline = time.time() + deadline if deadline else None
+        self._stale_computers = []
         if self._must_login():
-            self._do_login()
+            if not self._load_cookie():
+                self._do_login()
         else:
             # If we dont need to login, we ignore the cookie
             self.cookie = None
 
+        try:
+            return self._read_data_from_jenkins(on_computer)
+        except JenkinsHTTPError as e:
+            if not (self._cookie_cached and self._is_login_required(e)):
+                raise
+            # Jenkins forgot the cached session, it's the first request
+            #  that fails, so we didn't lose much
+            display.vvv('The cached jsessionid is not valid anymore ({0}), login again.'.format(e))
+            self._do_login()
+            return self._read_data_from_jenkins(on_computer)
+
+    def _is_login_required(self, error):
+        if error.status in (401, 403):
+            return True
+        location = error.headers.get('Location', '') if error.headers is not None else ''
+        return 300 <= error.status < 400 and 'login' in (location or '')
+
+    def _read_data_from_jenkins(self, on_computer=None):
         data = self._init_empty_inventory()
+        # Strings of the computers read in this run, see ComputerRecord
+        self._interned_texts = {}
+
+        include = ComputerFilter('include', self._options.get('include', None))
+        exclude = ComputerFilter('exclude', self._options.get('exclude', None))
+
+        # Merge in the same order jenkins listed the computers, no matter
+        #  the order the requests finished, so the data is always the same.
+        #  Every computer is merged as soon as it and the ones before it are
+        #  read, while the requests of the ones after it are still running
+        children = set(data['all']['children'])
+        left_out = []
+
+        def add_computer(computer, computer_record):
+            # Left out by the deadline
+            if computer_record is None:
+                left_out.append(computer['displayName'])
+                return
+            groups = self.add_computer_2_data(computer, data, computer_record, children)
+            if on_computer is not None:
+                on_computer(computer['displayName'], groups, data)
+
+        computers = None
+        if self._options.get('fetch_mode', 'config') == 'script':
+            with self._get_metrics().phase('fetch'):
+                computers, computers_records = self._get_computers_from_script()
+
+        if computers is not None:
+            for computer, computer_record in zip(computers, computers_records):
+                if self._select_computer(computer, include, exclude):
+                    add_computer(computer, computer_record)
+        else:
+            labels_needed = include.labels or exclude.labels
 
-        all_computers = self._get_all_computers()
-        for computer in all_computers:
-            if computer['_class'] == 'hudson.model.Hudson$MasterComputer':
-                # Skip master node
-                continue
-            self.add_computer_2_data(computer, data)
+            self._load_node_cache()
+            if self._options.get('engine', 'threads') == 'async':
+                asyncio.run(self._get_computers_async(labels_needed, include, exclude, add_computer))
+            else:
+                computers = self._select_computers(self._get_all_computers(labels_needed), include, exclude)
+                computer_names = [computer['displayName'] for computer in computers]
+                with self._get_metrics().phase('fetch'), \
+                        closing(self._iter_computers_records(computer_names)) as computers_records:
+                    for computer, computer_record in zip(computers, computers_records):
+                        add_computer(computer, computer_record)
+            # Only the listed computers are kept, removed ones are dropped
+            self._save_node_cache()
+
+        if self._stale_computers:
+            display.warning('Jenkins computers not read in time or failing: {0} use the last data known of them, '
+                            '{1} were left out. First ones: {2}'.format(len(self._stale_computers) - len(left_out),
+                                                                        len(left_out),
+                                                                        ', '.join(self._stale_computers[:5])))
 
         return data
 
-    def add_computer_2_data(self, computer, data):
-        computer_name = computer['displayName']
-        computer_info = self._get_computer_info(computer_name)
+    def _select_computers(self, all_computers, include, exclude):
+        # Skip master node, and the ones filtered, before asking for their config.xml
+        return [computer for computer in all_computers
+                if computer['_class'] != MASTER_COMPUTER_CLASS and
+                self._select_computer(computer, include, exclude)]
+
+    def _select_computer(self, computer, include, exclude):
+        if include and not include.matches(computer):
+            return False
+        if exclude and exclude.matches(computer):
+            return False
+        return True
+
+    def _iter_computers_records(self, computer_names):
+        ''' Records of the computers, in the same order, each one as soon as it is read. '''
+        max_workers = self._options.get('max_workers', 1) or 1
+
+        if self._deadline is None and (max_workers <= 1 or len(computer_names) <= 1):
+            for computer_name in computer_names:
+                yield self._get_computer_record(computer_name)
+            return
+
+        if not computer_names:
+            return
+
+        executor = concurrent_futures.ThreadPoolExecutor(max_workers=min(max_workers, len(computer_names)))
+        try:
+            futures = [executor.submit(self._get_computer_record, name) for name in computer_names]
+            for computer_name, future in zip(computer_names, futures):
+                if self._deadline is None:
+                    yield future.result()
+                else:
+                    concurrent_futures.wait([future], timeout=max(0, self._deadline - time.time()))
+                    yield self._get_finished_record(computer_name, future)
+        finally:
+            # Threads can't be stopped, the requests still running at the
+            #  deadline are left behind (their timeout is the deadline at most)
+            executor.shutdown(wait=self._deadline is None, cancel_futures=True)
+
+    async def _get_computers_async(self, labels_needed, include, exclude, add_computer):
+        # Every request is driven by this event loop, max_workers is the
+        #  maximum number of requests (and connections) open at the same time
+        limiter = AsyncAdaptiveLimiter(self._options.get('max_workers', 1) or 1,
+                                       adaptive=self._options.get('adaptive_concurrency', False),
+                                       target_latency=self._options.get('target_latency', 1.0))
+        session = AsyncJenkinsSession(self._get_jenkins_host(),
+                                      timeout=self._options.get('timeout', None),
+                                      retries=self._options.get('retries', 0),
+                                      retry_timeouts=self._options.get('retry_timeouts', False),
+                                      limiter=limiter,
+                                      metrics=self._get_metrics(),
+                                      deadline=self._deadline)
+        try:
+            with self._get_metrics().phase('listing'):
+                r = await session.request('GET', self._get_all_computers_url(labels_needed),
+                                          headers=self._get_headers())
+                computers = self._select_computers(self._read_all_computers(r), include, exclude)
+
+            async def get_computer_record(computer_name):
+                start = time.time()
+                headers = self._get_computer_config_headers(computer_name)
+                r = await session.request('GET', self._get_computer_config_url(computer_name),
+                                          headers=headers)
+                self._get_metrics().node_time(computer_name, time.time() - start)
+                return self._computer_config_2_record(computer_name, r)
+
+            with self._get_metrics().phase('fetch'):
+                tasks = [asyncio.ensure_future(get_computer_record(computer['displayName']))
+                         for computer in computers]
+                try:
+                    # In listing order, the other requests go on while
+                    #  every computer is added
+                    for computer, task in zip(computers, tasks):
+                        if self._deadline is None:
+                            computer_record = await task
+                        else:
+                            await asyncio.wait([task], timeout=max(0, self._deadline - time.time()))
+                            computer_record = self._get_finished_record(computer['displayName'], task)
+                        add_computer(computer, computer_record)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            session.close()
+
+    def _get_finished_record(self, computer_name, future):
+        # future: concurrent.futures.Future or asyncio.Task
+        if future.cancelled() or not future.done():
+            reason = 'deadline exceeded'
+        elif future.exception() is not None:
+            reason = future.exception()
+        else:
+            return future.result()
+
+        self._stale_computers.append(computer_name)
+        cached = self._node_cache.get(computer_name) if self._node_cache is not None else None
+        if cached is None:
+            display.vvv('Computer {0} left out: {1}'.format(computer_name, reason))
+            return None
+
+        display.vvv('Computer {0} uses the last data known: {1}'.format(computer_name, reason))
+        # Kept for the next run
+        self._new_node_cache[computer_name] = cached
+        return cached['record'].stale_copy()
+
+    def _get_computer_record(self, computer_name):
+        start = time.time()
+        r = self._request_computer_config(computer_name,
+                                          self._get_computer_config_headers(computer_name))
+        self._get_metrics().node_time(computer_name, time.time() - start)
+        return self._computer_config_2_record(computer_name, r)
+
+    def _get_computer_config_headers(self, computer_name):
+        headers = self._get_headers()
+
+        cached = self._node_cache.get(computer_name) if self._node_cache is not None else None
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
 
-        labels = [l.strip() for l in str(computer_info.label).strip().split(' ') if len(l) > 0]
+        return headers
 
-        if len(labels) == 0:
-            groups = ['ungrouped']
+    def _computer_config_2_record(self, computer_name, r):
+        if self._node_cache is None:
+            return self._parse_computer_config(computer_name, r.read())
+
+        cached = self._node_cache.get(computer_name)
+
+        if r.status == 304:
+            display.vvvv('Computer {0} not modified, using the cached one'.format(computer_name))
+            self._get_metrics().count('node_cache_hits')
+            entry = cached
         else:
-            groups = labels
+            xml_config = r.read()
+            digest = hashlib.sha1(xml_config).hexdigest()
+            if cached is not None and cached.get('digest') == digest:
+                display.vvvv('Computer {0} did not change, using the cached one'.format(computer_name))
+                self._get_metrics().count('node_cache_hits')
+                record = cached['record']
+            else:
+                self._get_metrics().count('node_cache_misses')
+                record = self._parse_computer_config(computer_name, xml_config)
+            entry = {'etag': r.headers.get('ETag'),
+                     'last_modified': r.headers.get('Last-Modified'),
+                     'digest': digest,
+                     'record': record}
+
+        # Every computer writes its own key, no lock needed
+        self._new_node_cache[computer_name] = entry
+
+        return entry['record']
+
+    def _get_computers_from_script(self):
+        headers = self._get_headers()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        data = urlencode({'script': COMPUTERS_SCRIPT}).encode('utf-8')
+
+        if self._needs_crumb():
+            # Out of the try, a failure here is not about the script (a
+            #  cached session jenkins forgot logs in again)
+            headers.update(self._get_crumb())
+
+        try:
+            r = self._get_session().request('POST', 'scriptText', data=data, headers=headers)
+        except JenkinsHTTPError as e:
+            # With a cached session, it can be jenkins that forgot it
+            if e.status not in (401, 403) or self._cookie_cached:
+                raise
+            display.warning('Jenkins refused to run the computers script ({0}), '
+                            'reading every config.xml instead.'.format(e))
+            return None, None
+
+        try:
+            script_computers = json.loads(r.read().decode('utf-8'))
+        except ValueError:
+            # The script console prints the groovy errors as plain text
+            raise AnsibleError('Unexpected answer from the jenkins script console: {0}'.format(r.read()[:500].decode('utf-8', 'replace')))
+
+        computers = []
+        computers_records = []
+        for script_computer in script_computers:
+            computer_record = self._script_computer_2_record(script_computer)
+            # Same fields we get from computer/api/json
+            computers.append({'_class': script_computer['_class'],
+                              'displayName': script_computer['displayName'],
+                              'idle': script_computer['idle'],
+                              'offline': script_computer['offline'],
+                              'temporarilyOffline': script_computer['temporaryOffline'],
+                              'numExecutors': script_computer['numExecutors'],
+                              'assignedLabels': [{'name': label} for label in
+                                                 list(computer_record.labels) + [script_computer['displayName']]]})
+            computers_records.append(computer_record)
+
+        return computers, computers_records
+
+    def _needs_crumb(self):
+        # Jenkins asks a crumb to the requests of a session and to the ones
+        #  with a password, not to the ones with an api token
+        jenkins_pass = self._get_jenkins_pass()
+        return self._must_login() or jenkins_pass is None or not API_TOKEN.fullmatch(jenkins_pass)
+
+    def _get_crumb(self):
+        ''' Headers with the crumb, {} if jenkins has no CSRF protection.
+
+            The crumb belongs to the web session, the one jenkins starts
+            answering a basic auth request is sent too.
+        '''
+        try:
+            r = self._get_session().request('GET', 'crumbIssuer/api/json',
+                                            headers=self._get_headers())
+        except JenkinsHTTPError as e:
+            if e.status == 404:
+                # CSRF protection disabled
+                return {}
+            raise
+
+        crumb = json.loads(r.read().decode('utf-8'))
+        headers = {crumb['crumbRequestField']: crumb['crumb']}
+        if self.cookie is None and r.headers.get_all('Set-Cookie'):
+            headers['Cookie'] = self._extract_cookie(r.headers)
+        return headers
 
-        for group in groups:
-            group_value = data.get(group, self._get_empty_group())
-            group_value['hosts'].append(computer_name)
-            data[group] = group_value
-            if group == "":
-                raise AnsibleError('Empty group not allowed. Computer: <{0}>'.format(computer_name))
+    def _script_computer_2_record(self, script_computer):
+        # Same values we would get from the config.xml, objectify included
+        labels = self._split_labels(objectify_text(script_computer['labelString'] or ''))
 
-            if group not in data['all']['children']:
-                data['all']['children'].append(group)
+        host = script_computer['host']
+        if host is not None:
+            host = objectify_text(str(host))
+        port = script_computer['port']
+        if port is not None:
+            port = objectify_text(str(port))
 
-        host_vars = {}
+        properties = {}
+        for prop_name, prop_value in script_computer['envVars'].items():
+            prop_name = objectify_text(prop_name)
+            if prop_name not in FORBIDDEN_PROPERTIES:
+                properties[prop_name] = objectify_text(prop_value)
+
+        return ComputerRecord(labels, script_computer['launcher'] or '', host, port,
+                              script_computer['temporaryOffline'], properties, self._interned_texts)
+
+    def _parse_computer_config(self, computer_name, xml_config):
+        with self._get_metrics().phase('xml_parse'):
+            try:
+                return extract_computer_config(xml_config, self._interned_texts)
+            except ValueError as e:
+                # Unusual config.xml, let objectify deal with it
+                display.vvvv('Computer {0} config read with objectify: {1}'.format(computer_name, e))
+                return self._computer_info_2_record(objectify.fromstring(xml_config))
 
-        host_vars['launcher_plugin'] = str(computer_info.launcher.attrib['plugin'])
+    def _computer_info_2_record(self, computer_info):
+        # Only the values taken from the config.xml, the ones coming
+        #  from the computers list are added later on
+        labels = self._split_labels(str(computer_info.label))
 
-        host_vars['inventory_hostname'] = computer_name
         # Host could not be present in a "launched by command" computer
+        host = None
         if hasattr(computer_info.launcher, "host"):
-            host_vars['ansible_host'] = str(computer_info.launcher.host)
+            host = str(computer_info.launcher.host)
         # Port could not be defined if it's a windows computer
+        port = None
         if hasattr(computer_info.launcher, "port"):
-            host_vars['ansible_port'] = str(computer_info.launcher.port)
+            port = str(computer_info.launcher.port)
 
-        host_vars['temporary_offline'] = hasattr(computer_info, 'temporaryOfflineCause')
+        return ComputerRecord(labels, str(computer_info.launcher.attrib['plugin']), host, port,
+                              hasattr(computer_info, 'temporaryOfflineCause'),
+                              self.get_node_properties(computer_info), self._interned_texts)
 
-        host_vars['idle'] = computer['idle']
-        host_vars['offline'] = computer['offline']
-        host_vars['num_executors'] = computer['numExecutors']
+    def _split_labels(self, label_string):
+        return [label.strip() for label in label_string.strip().split(' ') if len(label) > 0]
 
-        host_vars.update(self.get_node_properties(computer_info))
+    def add_computer_2_data(self, computer, data, computer_record=None, children=None):
+        # children: set with the groups in data['all']['children'], so we
+        #  don't look for every label in that list
+        computer_name = computer['displayName']
+        if computer_record is None:
+            computer_record = self._computer_info_2_record(self._get_computer_info(computer_name))
+        if children is None:
+            children = set(data['all']['children'])
 
-        data['_meta']['hostvars'][computer_name] = host_vars
+        computer_record.set_state(computer)
+        labels = computer_record.labels
 
-    def get_node_properties(self, computer_xml_info):
-        # We don't want anyone to override those properties, it could lead to serious problems if it happens
-        forbidden_properties = ['launcher_plugin',
-                                'inventory_hostname',
-                                'ansible_host',
-                                'ansible_port',
-                                'temporary_offline']
+        groups = list(labels)
+        if len(groups) == 0:
+            groups = ['ungrouped']
+
+        for group in groups:
+            if group not in data:
+                data[group] = self._get_empty_group()
+            data[group]['hosts'].append(computer_name)
+            if group == "":
+                raise AnsibleError('Empty group not allowed. Computer: <{0}>'.format(computer_name))
+
+            if group not in children:
+                children.add(group)
+                data['all']['children'].append(group)
 
+        data['_meta']['hostvars'][computer_name] = computer_record.host_vars()
+        return groups
+
+    def get_node_properties(self, computer_xml_info):
         num_prop_path = './/nodeProperties/hudson.slaves.EnvironmentVariablesNodeProperty/envVars/tree-map/int'
         all_props_path = './/nodeProperties/hudson.slaves.EnvironmentVariablesNodeProperty/envVars/tree-map/string'
 
@@ -249,7 +2533,7 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
                 if prop_name is not None \
                    and prop_value is not None \
-                   and prop_name not in forbidden_properties:
+                   and prop_name not in FORBIDDEN_PROPERTIES:
                     node_properties[prop_name] = prop_value
 
         return node_properties
@@ -274,23 +2558,21 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             self.inventory.set_variable(computer, 'ansible_host', host)
             self.inventory.set_variable(computer, 'ansible_port', port)
 
+    def _get_computer_config_url(self, computer):
+        return 'computer/{0}/config.xml'.format(quote(computer))
+
+    def _request_computer_config(self, computer, headers):
+        return self._get_session().request('GET', self._get_computer_config_url(computer),
+                                           headers=headers)
+
     def _get_computer_info(self, computer):
-        computer_url = 'computer/{0}/config.xml'.format(computer)
-        jenkins_host = self._get_jenkins_host()
-        config_url = '{0}/{1}'.format(jenkins_host, computer_url)
-
-        r = open_url(config_url, use_proxy=False,
-                     validate_certs=False,
-                     method='GET',
-                     timeout=self._options.get('timeout', None),
-                     force_basic_auth=(not self._must_login()),
-                     url_username=self._get_jenkins_user(),
-                     url_password=self._get_jenkins_pass(),
-                     force=False,
-                     headers=self._get_headers())
+        start = time.time()
+        r = self._request_computer_config(computer, self._get_headers())
+        self._get_metrics().node_time(computer, time.time() - start)
 
         xml_config = r.read()
-        computer = objectify.fromstring(xml_config)
+        with self._get_metrics().phase('xml_parse'):
+            computer = objectify.fromstring(xml_config)
 
         return computer
 
@@ -300,23 +2582,27 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         else:
             headers = {}
 
+        if not self._must_login() and self._get_jenkins_user() is not None:
+            credentials = '{0}:{1}'.format(self._get_jenkins_user(), self._get_jenkins_pass())
+            headers['Authorization'] = 'Basic {0}'.format(base64.b64encode(credentials.encode('utf-8')).decode('ascii'))
+
         return headers
 
-    def _get_all_computers(self):
-        computers_api_url = 'computer/api/json'
-        jenkins_host = self._get_jenkins_host()
-        api_url = '{0}/{1}'.format(jenkins_host, computers_api_url)
-
-        r = open_url(api_url, use_proxy=False,
-                     validate_certs=False,
-                     headers=self._get_headers(),
-                     timeout=self._options.get('timeout', None),
-                     force_basic_auth=(not self._must_login()),
-                     url_username=self._get_jenkins_user(),
-                     url_password=self._get_jenkins_pass(),
-                     force=True,
-                     method='GET')
+    def _get_all_computers_url(self, labels=False):
+        # Only the fields we use, jenkins sends a lot more by default
+        fields = COMPUTER_FIELDS
+        if labels:
+            fields += ',assignedLabels[name]'
+        return 'computer/api/json?tree=computer[{0}]'.format(fields)
 
+    def _get_all_computers(self, labels=False):
+        with self._get_metrics().phase('listing'):
+            r = self._get_session().request('GET', self._get_all_computers_url(labels),
+                                            headers=self._get_headers())
+
+            return self._read_all_computers(r)
+
+    def _read_all_computers(self, r):
         computers_json = json.loads(r.read().decode('utf-8'))
 
         all_computers = computers_json['computer']
@@ -330,14 +2616,11 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         jenkins_pass = self._options.get('jenkins_pass', None)
 
         if jenkins_pass is None and self._get_jenkins_user() is not None:
-            jenkins_pass = getpass.getpass()
-            # For python 2 and 3 compatibility
-            try:
-                u_jenkins_pass = jenkins_pass.decode(sys.stdin.encoding).encode('UTF-8')
-            except (TypeError, AttributeError):
-                u_jenkins_pass = jenkins_pass.encode('UTF-8')
+            if self.master_name is None:
+                jenkins_pass = getpass.getpass()
+            else:
+                jenkins_pass = getpass.getpass('Password for jenkins master {0}: '.format(self.master_name))
             # Save the pass not to ask it once and again and again
-            jenkins_pass = u_jenkins_pass.decode('UTF-8')
             self._options['jenkins_pass'] = jenkins_pass
 
         return jenkins_pass
@@ -359,19 +2642,95 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         return valid
 
     def _data_2_inventory(self, data):
+        if isinstance(data, CompactData):
+            return self._compact_data_2_inventory(data)
+
         hostvars = data.get('_meta', {}).get('hostvars', {})
 
+        # A host is in as many groups as labels it has, but its variables
+        #  are set only the first time we see it
+        populated = set()
+        host_groups = {}
         for group in data:
-            if group == 'all':
+            if group in ('all', '_meta'):
                 continue
             else:
                 self.inventory.add_group(group)
                 hosts = data[group].get('hosts', [])
                 for host in hosts:
-                    self._populate_host_vars([host], hostvars.get(host, {}), group)
+                    if host in populated:
+                        self.inventory.add_child(group, host)
+                    else:
+                        populated.add(host)
+                        self._populate_host_vars([host], hostvars.get(host, {}), group)
+                    if self._label_groups:
+                        host_groups.setdefault(host, []).append(group)
 
                 self.inventory.add_child('all', group)
 
+        for host, groups in host_groups.items():
+            self._add_label_groups_2_inventory(host, groups, hostvars.get(host, {}))
+
+    def _add_computer_2_inventory(self, computer_name, groups, data):
+        # Same as _data_2_inventory for a single computer. As the computers
+        #  come in listing order, the groups are created in the same order too
+        with self._get_metrics().phase('inventory'):
+            host_vars = data['_meta']['hostvars'][computer_name]
+            if self._label_groups:
+                groups = groups + self._matching_label_groups(computer_name, groups, host_vars)
+            for index, group in enumerate(groups):
+                new_group = group not in self._inventory_groups
+                if new_group:
+                    self.inventory.add_group(group)
+                if index == 0:
+                    self._populate_host_vars([computer_name], host_vars, group)
+                else:
+                    self.inventory.add_child(group, computer_name)
+                if new_group:
+                    self._inventory_groups.add(group)
+                    self.inventory.add_child('all', group)
+
+        with self._get_metrics().phase('compose'):
+            self._add_composed_hostvars([computer_name])
+
+    def _compact_data_2_inventory(self, compact):
+        # Same as _data_2_inventory, but the variables of a host are only
+        #  decoded when they are set
+        populated = set()
+        host_groups = {}
+        for group_index, host_indexes in compact.groups:
+            group = compact.strings[group_index]
+            if group == '_meta':
+                continue
+            self.inventory.add_group(group)
+            for host_index in host_indexes:
+                host = compact.host_name(host_index)
+                if host_index in populated:
+                    self.inventory.add_child(group, host)
+                else:
+                    populated.add(host_index)
+                    self._populate_host_vars([host], compact.host_vars(host_index), group)
+                if self._label_groups:
+                    host_groups.setdefault(host_index, []).append(group)
+
+            self.inventory.add_child('all', group)
+
+        for host_index, groups in host_groups.items():
+            host = compact.host_name(host_index)
+            self._add_label_groups_2_inventory(host, groups, compact.host_vars(host_index))
+
+    def _matching_label_groups(self, host, groups, host_vars):
+        # As jenkins does, the name of the computer is one of its labels
+        labels = [group for group in groups if group not in self._not_labels]
+        labels.append(host_vars.get('inventory_hostname', host))
+        return [group for group in self._label_groups.matching(labels) if group not in groups]
+
+    def _add_label_groups_2_inventory(self, host, groups, host_vars):
+        for group in self._matching_label_groups(host, groups, host_vars):
+            self.inventory.add_group(group)
+            self.inventory.add_child(group, host)
+            self.inventory.add_child('all', group)
+
     def _get_empty_group(self):
         return {
             'children': [],
@@ -390,3 +2749,57 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 'vars': {}
             }
         }
+
+
+def load_inventory_plugin(path):
+    ''' Plugin with the options of an inventory file, loaded as ansible-inventory does. '''
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.plugins.loader import inventory_loader
+
+    # Through the loader, so the options are the documented ones
+    inventory_loader.add_directory(os.path.dirname(os.path.abspath(__file__)))
+    plugin = inventory_loader.get('jenkins')
+    BaseInventoryPlugin.parse(plugin, InventoryData(), DataLoader(), path)
+    plugin._read_config_data(path)
+    return plugin
+
+
+def main(argv=None):
+    ''' Writes the snapshot of an inventory file reading jenkins (from cron, for example), or reads it. '''
+    parser = argparse.ArgumentParser(description='Snapshot of a jenkins inventory. Without --list or --host, '
+                                                 'jenkins is read and the snapshot written.')
+    parser.add_argument('inventory', nargs='?', help='jenkins inventory file (*.jenkins.yml)')
+    parser.add_argument('--snapshot', help='snapshot file, the snapshot_path of the inventory file by default')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--list', action='store_true', help='print the whole inventory of the snapshot')
+    action.add_argument('--host', help='print the variables of a host of the snapshot')
+    args = parser.parse_args(argv)
+
+    try:
+        plugin = load_inventory_plugin(args.inventory) if args.inventory else None
+        snapshot = args.snapshot or (plugin and plugin.get_option('snapshot_path'))
+        if not snapshot:
+            parser.error('the snapshot file is needed, use --snapshot or the snapshot_path option')
+
+        if args.host is not None:
+            print(json.dumps(read_snapshot_host(snapshot, args.host) or {}))
+        elif args.list:
+            print(json.dumps(read_snapshot(snapshot)))
+        elif plugin is None:
+            parser.error('the inventory file is needed to read jenkins')
+        else:
+            try:
+                data = plugin.get_data_from_jenkins()
+            finally:
+                plugin._report_metrics()
+            write_snapshot(snapshot, data)
+            display.display('Snapshot of {0} hosts written to {1}'.format(len(data['_meta']['hostvars']), snapshot))
+    except AnsibleError as e:
+        display.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+'''
+Benchmark of the jenkins inventory plugin against the fake jenkins.
+
+The plugin is loaded and InventoryModule.parse is run end to end, as
+ansible-inventory does, for every number of nodes asked. For every run it
+reports:
+    - wall time of the parse
+    - requests received by jenkins
+    - peak RSS of the process running the parse (it is forked for every run,
+      so the modules already imported are counted too)
+    - time spent in every phase, as the plugin metrics count it. Without
+      cache the computers are added to the inventory while the next ones
+      are read, so the fetch phase includes the inventory and compose ones,
+      and the xml parsing is the sum of every thread.
+
+With --startup it measures the start instead: a parse without cache and
+then parses from the cache, each one in a new interpreter, with the time
+to load the plugin and the modules only needed to read jenkins it loaded.
+
+Examples, from the repository root (python 3):
+    python unittests/benchmark.py --nodes 10,100,1000,10000 --latency 0.005 --max-workers 16
+    python unittests/benchmark.py --engine async --login --output before.json
+    python unittests/benchmark.py --baseline before.json --tolerance 0.25
+    python unittests/benchmark.py --startup --nodes 1000 --repeat 5
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import inventory_loader
+
+from fake_jenkins import FakeJenkins
+
+
+PHASE_NAMES = ('login', 'listing', 'fetch', 'xml_parse', 'inventory', 'compose')
+
+# Differences smaller than this are noise, not regressions
+NOISE_SECONDS = 0.01
+
+CONFIG_TEMPLATE = '''plugin: jenkins
+jenkins_host: {url}
+max_workers: {max_workers}
+engine: {engine}
+fetch_mode: {fetch_mode}
+compose:
+    ansible_connection: ('indows' in launcher_plugin)|ternary('winrm', 'ssh')
+groups:
+    temporary_offline: (temporary_offline)
+keyed_groups:
+    - prefix: oss
+      key: launcher_plugin.split('@')[0]
+'''
+
+LOGIN_TEMPLATE = '''jenkins_user: benchmark
+jenkins_pass: benchmark
+jenkins_jsessionid: True
+'''
+
+CACHE_TEMPLATE = '''cache: true
+cache_plugin: jsonfile
+cache_connection: {cache_dir}
+'''
+
+# Only needed to read jenkins (or to ask for the password), the plugin loads them when used
+LAZY_MODULES = ('asyncio', 'concurrent.futures', 'getpass', 'http.client', 'lxml.etree', 'lxml.objectify',
+                'mmap', 'ssl')
+
+# Run by a new interpreter, so nothing else is imported: not even this file,
+#  since the fake jenkins imports http.client
+STARTUP_PARSE = '''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import inventory_loader
+
+ansible_loaded = time.perf_counter()
+preloaded = set(sys.modules)
+inventory_loader.add_directory({repository_dir!r})
+plugin = inventory_loader.get('jenkins')
+plugin_loaded = time.perf_counter()
+inventory = InventoryData()
+plugin.parse(inventory, DataLoader(), {path!r}, cache=True)
+plugin.update_cache_if_changed()
+parsed = time.perf_counter()
+
+print(json.dumps({{'ansible': ansible_loaded - start,
+                  'plugin': plugin_loaded - ansible_loaded,
+                  'parse': parsed - plugin_loaded,
+                  'hosts': len(inventory.hosts),
+                  'loaded': [module for module in {lazy_modules!r} if module in sys.modules and module not in preloaded],
+                  'preloaded': [module for module in {lazy_modules!r} if module in preloaded]}}))
+'''
+
+
+def write_config(directory, jenkins, args):
+    path = os.path.join(directory, 'benchmark.jenkins.yml')
+    config = CONFIG_TEMPLATE.format(url=jenkins.url, max_workers=args.max_workers,
+                                    engine=args.engine, fetch_mode=args.fetch_mode)
+    if args.login:
+        config += LOGIN_TEMPLATE
+    if args.startup:
+        config += CACHE_TEMPLATE.format(cache_dir=os.path.join(directory, 'cache'))
+    with open(path, 'w') as config_file:
+        config_file.write(config)
+    return path
+
+
+def run_parse(path, connection):
+    ''' Runs in the forked process, so the peak RSS is the one of this parse. '''
+    plugin = inventory_loader.get('jenkins')
+    inventory = InventoryData()
+    start = time.perf_counter()
+    plugin.parse(inventory, DataLoader(), path, cache=False)
+    wall = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes in linux and in bytes in mac
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    connection.send({'wall': wall,
+                     'hosts': len(inventory.hosts),
+                     'peak_rss': peak_rss,
+                     'phases': dict((phase, plugin._metrics.phases[phase]) for phase in PHASE_NAMES)})
+    connection.close()
+
+
+def run_scenario(nodes, args):
+    with FakeJenkins(nodes=nodes, labels=args.labels, env_vars=args.env_vars,
+                     latency=args.latency) as jenkins:
+        directory = tempfile.mkdtemp()
+        try:
+            path = write_config(directory, jenkins, args)
+            best = None
+            for _ in range(args.repeat):
+                requests = jenkins.count()
+                parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.get_context('fork').Process(target=run_parse,
+                                                                      args=(path, child_connection))
+                process.start()
+                child_connection.close()
+                try:
+                    result = parent_connection.recv()
+                except EOFError:
+                    raise RuntimeError('the parse of {0} nodes failed'.format(nodes))
+                finally:
+                    process.join()
+                result['requests'] = jenkins.count() - requests
+                if best is None or result['wall'] < best['wall']:
+                    best = result
+        finally:
+            shutil.rmtree(directory)
+
+    best['nodes'] = nodes
+    return best
+
+
+def startup_parse(path):
+    ''' Parse in a new interpreter, with the cache of the inventory file. '''
+    code = STARTUP_PARSE.format(repository_dir=REPOSITORY_DIR, path=path, lazy_modules=LAZY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run_startup(nodes, args):
+    with FakeJenkins(nodes=nodes, labels=args.labels, env_vars=args.env_vars,
+                     latency=args.latency) as jenkins:
+        directory = tempfile.mkdtemp()
+        try:
+            path = write_config(directory, jenkins, args)
+            # The cache is empty the first time
+            results = []
+            for run in range(args.repeat + 1):
+                requests = jenkins.count()
+                result = startup_parse(path)
+                result['requests'] = jenkins.count() - requests
+                result['cache'] = 'miss' if run == 0 else 'hit'
+                results.append(result)
+        finally:
+            shutil.rmtree(directory)
+
+    hits = sorted(results[1:], key=lambda result: result['plugin'] + result['parse'])
+    return [results[0]] + hits[:1]
+
+
+def print_startup(results):
+    header = '{0:>7} {1:>9} {2:>9} {3:>9} {4:>9}  {5}'
+    print(header.format('cache', 'ansible', 'plugin', 'parse', 'requests', 'modules loaded by the plugin'))
+    for result in results:
+        line = '{0:>7} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>9}  {5}'
+        print(line.format(result['cache'], result['ansible'], result['plugin'], result['parse'], result['requests'],
+                          ', '.join(result['loaded']) or '-'))
+    print('Already loaded by ansible: {0}'.format(', '.join(results[0]['preloaded']) or '-'))
+
+
+def print_results(results):
+    header = '{0:>7} {1:>9} {2:>9} {3:>9} '.format('nodes', 'wall(s)', 'requests', 'rss(MB)')
+    header += ' '.join('{0:>9}'.format(phase) for phase in PHASE_NAMES)
+    print(header)
+    for result in results:
+        peak_rss = result['peak_rss'] / 1024.0 / 1024.0
+        line = '{0:>7} {1:>9.3f} {2:>9} {3:>9.1f} '.format(result['nodes'], result['wall'], result['requests'], peak_rss)
+        line += ' '.join('{0:>9.3f}'.format(result['phases'][phase]) for phase in PHASE_NAMES)
+        print(line)
+
+
+def find_regressions(results, baseline, tolerance):
+    ''' Times slower than the baseline ones by more than the tolerance. '''
+    baseline = dict((result['nodes'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        old = baseline.get(result['nodes'])
+        if old is None:
+            continue
+        timings = [('wall', result['wall'], old['wall'])]
+        timings += [(phase, result['phases'][phase], old['phases'].get(phase, 0.0)) for phase in PHASE_NAMES]
+        for name, new_seconds, old_seconds in timings:
+            if new_seconds > old_seconds * (1 + tolerance) and new_seconds - old_seconds > NOISE_SECONDS:
+                regressions.append('{0} nodes, {1}: {2:.3f}s, it was {3:.3f}s'.format(
+                    result['nodes'], name, new_seconds, old_seconds))
+    return regressions
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Benchmark of the jenkins inventory plugin.')
+    parser.add_argument('--nodes', default='10,100,1000',
+                        help='comma separated numbers of jenkins nodes (default: %(default)s)')
+    parser.add_argument('--labels', type=int, default=0, help='extra labels of every node')
+    parser.add_argument('--env-vars', type=int, default=0, help='extra environment variables of every node')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds jenkins sleeps before every answer')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads')
+    parser.add_argument('--fetch-mode', choices=('config', 'script'), default='config')
+    parser.add_argument('--login', action='store_true', help='log in and use the jsessionid')
+    parser.add_argument('--repeat', type=int, default=1, help='parses per number of nodes, the fastest is kept')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the start of a parse with and without cache, in new interpreters')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown over the baseline reported as a regression (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.startup:
+        print_startup(run_startup(int(args.nodes.split(',')[0]), args))
+        return 0
+
+    inventory_loader.add_directory(REPOSITORY_DIR)
+
+    results = [run_scenario(int(nodes), args) for nodes in args.nodes.split(',')]
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'arguments': vars(args), 'results': results}, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: {0}'.format(regression))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,405 @@
+'''
+Local stub of the few jenkins urls used by the inventory plugin:
+    - j_acegi_security_check
+    - computer/api/json
+    - computer/{SLAVENAME}/config.xml
+    - crumbIssuer/api/json
+    - scriptText
+
+It is used by the unittests and it can emulate big jenkins instances too.
+'''
+import base64
+import hashlib
+import json
+import re
+import socket
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from xml.sax.saxutils import escape
+
+
+# Jenkins api tokens, the legacy ones and the ones with the hash version
+API_TOKEN = re.compile(r'(?:11)?[0-9a-f]{32}')
+
+MASTER_COMPUTER = {u'_class': u'hudson.model.Hudson$MasterComputer',
+                   u'displayName': u'master',
+                   u'idle': True,
+                   u'offline': False,
+                   u'numExecutors': 2}
+
+
+def fake_computer_name(index):
+    return u'node{0}'.format(index)
+
+
+def fake_computer_index(computer_name):
+    return int(computer_name.replace('node', ''))
+
+
+def fake_computers(count, labels=0):
+    # Jenkins adds the computer name to its labels
+    return [MASTER_COMPUTER] + [{u'_class': u'hudson.slaves.SlaveComputer',
+                                 u'displayName': fake_computer_name(index),
+                                 u'idle': index % 2 == 0,
+                                 u'offline': index % 3 == 0,
+                                 u'temporarilyOffline': index % 4 == 3,
+                                 u'numExecutors': 1,
+                                 u'assignedLabels': [{u'name': label} for label in
+                                                     fake_labels(index, labels) + [fake_computer_name(index)]]}
+                                for index in range(count)]
+
+
+def fake_labels(index, labels=0):
+    return [u'linux', u'label{0}'.format(index)] + [u'tag{0}'.format(tag) for tag in range(labels)]
+
+
+def fake_launcher(index):
+    # (plugin, host, port)
+    if index % 7 == 6:
+        return (u'command-launcher@1.2', None, None)
+    if index % 5 == 4:
+        return (u'windows-slaves@1.3.1', u'10.0.1.{0}'.format(index % 256), None)
+    return (u'ssh-slaves@1.26', u'10.0.0.{0}'.format(index % 256), u'22')
+
+
+def fake_env_vars(index, env_vars=0):
+    # Sorted the way jenkins stores them (case insensitive tree map)
+    variables = [(u'ansible_host', u'forbidden'),
+                 (u'ENV_INDEX', u'{0}'.format(index)),
+                 (u'FLAG', u'true')]
+    variables += [(u'VAR{0}'.format(var), u'value{0}'.format(var)) for var in range(env_vars)]
+    return sorted(variables, key=lambda variable: variable[0].lower())
+
+
+def fake_config_xml(computer_name, labels=0, env_vars=0):
+    index = fake_computer_index(computer_name)
+    plugin, host, port = fake_launcher(index)
+
+    launcher = u''
+    if host is not None:
+        launcher += u'\n    <host>{0}</host>'.format(host)
+    if port is not None:
+        launcher += u'\n    <port>{0}</port>'.format(port)
+
+    variables = fake_env_vars(index, env_vars)
+    strings = u''.join(u'\n          <string>{0}</string>\n          <string>{1}</string>'.format(escape(name), escape(value))
+                       for name, value in variables)
+
+    offline = u''
+    if index % 4 == 3:
+        offline = u'''
+  <temporaryOfflineCause class="hudson.slaves.OfflineCause$UserCause">
+    <timestamp>1500000000000</timestamp>
+    <description>
+      <holder><owner>hudson.slaves.Messages</owner></holder>
+      <key>SlaveComputer.DisconnectedBy</key>
+      <args><string>admin</string><string> : maintenance</string></args>
+    </description>
+  </temporaryOfflineCause>'''
+
+    return u'''<?xml version='1.1' encoding='UTF-8'?>
+<slave>
+  <name>{name}</name>
+  <description>Node number {index}</description>
+  <remoteFS>/home/jenkins</remoteFS>
+  <numExecutors>1</numExecutors>
+  <mode>NORMAL</mode>
+  <retentionStrategy class="hudson.slaves.RetentionStrategy$Always"/>
+  <launcher class="fake.Launcher" plugin="{plugin}">{launcher}
+  </launcher>
+  <label>{labels}</label>
+  <nodeProperties>
+    <hudson.slaves.EnvironmentVariablesNodeProperty>
+      <envVars serialization="custom">
+        <unserializable-parents/>
+        <tree-map>
+          <default>
+            <comparator class="hudson.util.CaseInsensitiveComparator"/>
+          </default>
+          <int>{count}</int>{strings}
+        </tree-map>
+      </envVars>
+    </hudson.slaves.EnvironmentVariablesNodeProperty>
+  </nodeProperties>{offline}
+</slave>'''.format(name=escape(computer_name), index=index, plugin=plugin,
+                   launcher=launcher, labels=u' '.join(fake_labels(index, labels)),
+                   count=len(variables), strings=strings,
+                   offline=offline).encode('utf-8')
+
+
+def fake_script_output(count, labels=0, env_vars=0):
+    ''' What the groovy script of the "script" fetch mode prints. '''
+    computers = []
+    for computer in fake_computers(count)[1:]:
+        index = fake_computer_index(computer['displayName'])
+        plugin, host, port = fake_launcher(index)
+        script_computer = dict((field, computer[field]) for field in
+                               ('_class', 'displayName', 'idle', 'offline', 'numExecutors'))
+        script_computer.update({u'labelString': u' '.join(fake_labels(index, labels)),
+                                u'launcher': plugin,
+                                u'host': host,
+                                u'port': None if port is None else int(port),
+                                u'temporaryOffline': index % 4 == 3,
+                                u'envVars': dict(fake_env_vars(index, env_vars))})
+        computers.append(script_computer)
+
+    return json.dumps(computers).encode('utf-8')
+
+
+class FakeJenkinsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Lots of clients connect at once, as they do to a real jenkins
+    request_queue_size = 1024
+
+
+class FakeJenkins(object):
+    ''' Jenkins stub listening in a random local port.
+
+        nodes: number of computers, apart from the master.
+        labels/env_vars: extra labels and environment variables per computer.
+        latency: seconds slept before answering every request.
+        allow_script: if False, scriptText answers 403 like jenkins does
+            for users without the Overall/RunScripts permission.
+        chunked: send the bodies with chunked transfer encoding.
+        busy: number of config.xml requests answered with a 503, like an
+            overloaded jenkins does, before answering them properly.
+        slow_nodes: computers whose config.xml takes slow_latency seconds more.
+        broken_nodes: computers whose config.xml is answered with a 500.
+        redirect_to: url every request is redirected to (301), like a
+            jenkins moved to https does.
+        etags: send the ETag of every config.xml, and answer 304 when the
+            request has it in If-None-Match.
+        crumbs: CSRF protection, the POST requests but the login and the
+            ones with an api token need the crumb of their session. Without
+            it crumbIssuer/api/json answers 404, like jenkins does.
+
+        Every request is recorded with its headers and the client port,
+        which tells the connection it came through.
+    '''
+
+    def __init__(self, nodes=10, labels=0, env_vars=0, latency=0.0, allow_script=True, chunked=False, busy=0,
+                 slow_nodes=(), slow_latency=2.0, broken_nodes=(), redirect_to=None, etags=False,
+                 crumbs=False):
+        self.nodes = nodes
+        self.labels = labels
+        self.env_vars = env_vars
+        self.latency = latency
+        self.allow_script = allow_script
+        self.chunked = chunked
+        self.busy = busy
+        self.slow_nodes = slow_nodes
+        self.slow_latency = slow_latency
+        self.broken_nodes = broken_nodes
+        self.redirect_to = redirect_to
+        self.etags = etags
+        self.crumbs = crumbs
+        self.requests = []
+        self.connections = set()
+        self.sessions = []
+        self.forgotten_sessions = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self._server.server_port)
+
+    def count(self, path=None):
+        with self._lock:
+            return len([request for request in self.requests
+                        if path is None or request[1].startswith(path)])
+
+    def start(self):
+        self._server = FakeJenkinsServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _record(self, method, path, query, headers, client_port):
+        with self._lock:
+            self.requests.append((method, path, query, headers, client_port))
+
+    def close_connections(self):
+        ''' Every keep-alive connection is closed, as a load balancer does with the idle ones. '''
+        with self._lock:
+            connections, self.connections = self.connections, set()
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _new_session(self):
+        with self._lock:
+            self.sessions.append('JSESSIONID.fake=session{0}'.format(len(self.sessions)))
+            return self.sessions[-1]
+
+    def _valid_session(self, cookie):
+        with self._lock:
+            return cookie in self.sessions[self.forgotten_sessions:]
+
+    def forget_sessions(self):
+        ''' Every session is lost, as it happens when jenkins restarts. '''
+        with self._lock:
+            self.forgotten_sessions = len(self.sessions)
+
+    def _is_busy(self):
+        with self._lock:
+            if self.busy > 0:
+                self.busy -= 1
+                return True
+            return False
+
+    def _handler(self):
+        jenkins = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written apart, don't wait for the ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with jenkins._lock:
+                    jenkins.connections.add(self.connection)
+
+            def answer(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for header, value in (headers or []):
+                    self.send_header(header, value)
+                if status == 304:
+                    # Never a body, nor its length
+                    self.end_headers()
+                elif jenkins.chunked:
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for start in range(0, len(body), 1000):
+                        chunk = body[start:start + 1000]
+                        self.wfile.write('{0:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                    self.wfile.write(b'0\r\n\r\n')
+                else:
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def prepare(self):
+                url = urlsplit(self.path)
+                path = url.path
+                jenkins._record(self.command, path, unquote(url.query), dict(self.headers), self.client_address[1])
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                if jenkins.latency:
+                    time.sleep(jenkins.latency)
+                if jenkins.redirect_to:
+                    self.answer(301, headers=[('Location', jenkins.redirect_to.rstrip('/') + self.path)])
+                    return None
+                return path
+
+            def do_POST(self):
+                path = self.prepare()
+                if path is None:
+                    return
+
+                if path == '/j_acegi_security_check':
+                    cookie = jenkins._new_session()
+                    self.answer(302, headers=[('Set-Cookie', 'JSESSIONID.old=expired;Path=/'),
+                                              ('Set-Cookie', '{0};Path=/;HttpOnly'.format(cookie)),
+                                              ('Location', jenkins.url)])
+                elif not self.authorized():
+                    self.answer(403, b'Forbidden')
+                elif jenkins.crumbs and not self.valid_crumb():
+                    self.answer(403, b'No valid crumb was included in the request')
+                elif path == '/scriptText':
+                    if jenkins.allow_script:
+                        self.answer(200, fake_script_output(jenkins.nodes, jenkins.labels, jenkins.env_vars))
+                    else:
+                        self.answer(403, b'Forbidden')
+                else:
+                    self.answer(404, b'Not found')
+
+            def crumb_session(self):
+                # Session the crumb belongs to, jenkins starts one for basic auth
+                cookie = self.headers.get('Cookie')
+                if cookie is None:
+                    cookie = jenkins._new_session()
+                    return cookie, [('Set-Cookie', '{0};Path=/;HttpOnly'.format(cookie))]
+                return cookie, []
+
+            def valid_crumb(self):
+                authorization = self.headers.get('Authorization', '')
+                if authorization.startswith('Basic '):
+                    password = base64.b64decode(authorization[6:]).decode('utf-8').split(':', 1)[1]
+                    if API_TOKEN.fullmatch(password):
+                        return True
+                cookie = self.headers.get('Cookie')
+                return cookie is not None and self.headers.get('Jenkins-Crumb') == 'crumb-' + cookie
+
+            def authorized(self):
+                # Anonymous can read everything, unknown sessions nothing
+                cookie = self.headers.get('Cookie')
+                return cookie is None or jenkins._valid_session(cookie)
+
+            def do_GET(self):
+                path = self.prepare()
+                if path is None:
+                    return
+                parts = path.strip('/').split('/')
+
+                if not self.authorized():
+                    self.answer(302, headers=[('Location', '{0}login?from=%2F'.format(jenkins.url))])
+                elif path == '/computer/api/json':
+                    computers = fake_computers(jenkins.nodes, jenkins.labels)
+                    if 'assignedLabels' not in unquote(urlsplit(self.path).query):
+                        # Like jenkins, only the fields asked in the tree
+                        computers = [dict((field, value) for field, value in computer.items() if field != 'assignedLabels')
+                                     for computer in computers]
+                    body = json.dumps({u'computer': computers}).encode('utf-8')
+                    self.answer(200, body, [('Content-Type', 'application/json')])
+                elif path == '/crumbIssuer/api/json' and jenkins.crumbs:
+                    cookie, headers = self.crumb_session()
+                    body = json.dumps({u'crumbRequestField': u'Jenkins-Crumb', u'crumb': u'crumb-' + cookie})
+                    self.answer(200, body.encode('utf-8'), [('Content-Type', 'application/json')] + headers)
+                elif len(parts) == 3 and parts[0] == 'computer' and parts[2] == 'config.xml':
+                    name = unquote(parts[1])
+                    if name in jenkins.slow_nodes:
+                        time.sleep(jenkins.slow_latency)
+                    if jenkins._is_busy():
+                        self.answer(503, b'Service Unavailable', [('Retry-After', '0')])
+                    elif name in jenkins.broken_nodes:
+                        self.answer(500, b'Internal Server Error')
+                    elif name.startswith('node') and fake_computer_index(name) < jenkins.nodes:
+                        body = fake_config_xml(name, jenkins.labels, jenkins.env_vars)
+                        headers = [('Content-Type', 'application/xml')]
+                        if jenkins.etags:
+                            etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+                            if self.headers.get('If-None-Match') == etag:
+                                self.answer(304, headers=[('ETag', etag)])
+                                return
+                            headers.append(('ETag', etag))
+                        self.answer(200, body, headers)
+                    else:
+                        self.answer(404, b'Not found')
+                else:
+                    self.answer(404, b'Not found')
+
+        return Handler
@@ -1,12 +1,38 @@
-from jenkins import InventoryModule
+from jenkins import InventoryModule, LabelGroups, JenkinsResponse, JenkinsHTTPError, AIMDLimiter, extract_computer_config, \
+    JenkinsSession, AsyncJenkinsSession, AsyncAdaptiveLimiter, \
+    constructed_variables, CompactData, encode_compact_data, decode_compact_data, ComputerRecord, write_snapshot, read_snapshot, \
+    read_snapshot_host, main as jenkins_main
 
+import asyncio
+import base64
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
+from io import StringIO
 from unittest import TestCase
 import mock
 from mock import patch, MagicMock, mock_open, PropertyMock
 
+from ansible.errors import AnsibleError
+from ansible.plugins.cache import CachePluginAdjudicator
 from ansible.plugins.inventory import BaseInventoryPlugin
 from ansible.parsing.dataloader import DataLoader
+from ansible.inventory.data import InventoryData
+from ansible.template import Templar
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # Before ansible 2.19 every template was trusted
+    def trust_as_template(template):
+        return template
+
+from lxml import objectify
+
+from benchmark import startup_parse
+from fake_jenkins import FakeJenkins, fake_computers, fake_config_xml
 
 
 CACHE_TEST_KEY = 'cache_key_for_testing_purposes'
@@ -25,6 +51,32 @@ DATA_NO_CACHE = {u'compose':
                  u'/home/user/playbooks/cache'
                 }
 
+def fake_config_response(computer_name, headers):
+    return JenkinsResponse(computer_name, 200, 'OK', {}, fake_config_xml(computer_name))
+
+
+# Login with the jsessionid cookie, as most jenkins inventories do
+LOGIN_OPTIONS = {'jenkins_user': 'user', 'jenkins_pass': 'pass', 'jenkins_jsessionid': True}
+
+
+class JenkinsTestCase(TestCase):
+    ''' Tests with a state_dir of their own, removed once they are done. '''
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def get_inventory(self, jenkins_host, **options):
+        jenkins_inventory = InventoryModule()
+        jenkins_inventory._options.update({'jenkins_host': jenkins_host, 'state_dir': self.state_dir})
+        jenkins_inventory._options.update(options)
+        return jenkins_inventory
+
+    def get_data(self, jenkins, **options):
+        return self.get_inventory(jenkins.url, **options).get_data_from_jenkins()
+
 
 # TODO:  Decent UT?
 
@@ -50,12 +102,11 @@ class JenkinsInventory_Parse_Tests(TestCase):
         jenkins_inventory = InventoryModule()
         jenkins_inventory.parse(None, None, None, cache=False)
 
-        # Assert we retrieved the data from jenkins (Cache=False)
-        get_data_from_jenkins_mock.assert_called_once()
-        # Assert data was transformed to inventory
-        _data_2_inventory_mock.assert_called_once()
-        # Assert composed data was created
-        _add_composed_hostvars_mock.assert_called_once()
+        # Assert we retrieved the data from jenkins (Cache=False), adding
+        #  every computer to the inventory as soon as it is read
+        get_data_from_jenkins_mock.assert_called_once_with(on_computer=jenkins_inventory._add_computer_2_inventory)
+        # Assert the data was not transformed to inventory again
+        _data_2_inventory_mock.assert_not_called()
         # Assert the configuration file/params were loaded
         _read_config_mock.assert_called_once()
         # Assert the baseclass attributes were initialized
@@ -157,5 +208,1158 @@ class JenkinsInventory_Parse_Tests(TestCase):
         base_parse_mock.assert_called_once()
 
 
+class JenkinsInventory_Data_Tests(TestCase):
+
+    @patch.object(InventoryModule, '_must_login', return_value=False)
+    @patch.object(InventoryModule, '_request_computer_config',
+                  side_effect=fake_config_response)
+    @patch.object(InventoryModule, '_get_all_computers',
+                  return_value=fake_computers(20))
+    def test_parallel_data_is_the_same(self,
+                                       _get_all_computers_mock,
+                                       _request_computer_config_mock,
+                                       _must_login_mock):
+        '''
+        Tests that fetching the computers in parallel builds exactly
+            the same data as fetching them one after the other.
+        '''
+        jenkins_inventory = InventoryModule()
+
+        jenkins_inventory._options['max_workers'] = 1
+        serial_data = jenkins_inventory.get_data_from_jenkins()
+
+        jenkins_inventory._options['max_workers'] = 8
+        parallel_data = jenkins_inventory.get_data_from_jenkins()
+
+        self.assertEqual(serial_data, parallel_data)
+        # Master is skipped, every other computer is requested once per run
+        self.assertEqual(_request_computer_config_mock.call_count, 40)
+        self.assertEqual(list(parallel_data['_meta']['hostvars']),
+                         ['node{0}'.format(index) for index in range(20)])
+        self.assertEqual(parallel_data['_meta']['hostvars']['node3']['ENV_INDEX'], '3')
+        self.assertEqual(parallel_data['_meta']['hostvars']['node3']['ansible_host'], '10.0.0.3')
+
+
+class JenkinsInventory_Inventory_Tests(TestCase):
+
+    def inventory_content(self, inventory):
+        return dict((name, (sorted(host.name for host in group.get_hosts()),
+                            sorted(child.name for child in group.child_groups)))
+                    for name, group in inventory.groups.items()), \
+            dict((name, (host.get_vars(), sorted(group.name for group in host.get_groups())))
+                 for name, host in inventory.hosts.items())
+
+    @patch.object(InventoryModule, '_must_login', return_value=False)
+    @patch.object(InventoryModule, '_request_computer_config',
+                  side_effect=fake_config_response)
+    @patch.object(InventoryModule, '_get_all_computers',
+                  return_value=fake_computers(20))
+    def test_data_2_inventory(self,
+                              _get_all_computers_mock,
+                              _request_computer_config_mock,
+                              _must_login_mock):
+        '''
+        Tests that every host variable is set once, and the inventory is
+            the same we got setting them for every group of the host.
+        '''
+        jenkins_inventory = InventoryModule()
+        data = jenkins_inventory.get_data_from_jenkins()
+        self.assertEqual(data['all']['children'][:3], ['ungrouped', 'linux', 'label0'])
+        self.assertEqual(len(data['all']['children']), 22)
+
+        # Every group of every host populated its variables
+        expected_inventory = InventoryData()
+        for group in data:
+            if group not in ('all', '_meta'):
+                expected_inventory.add_group(group)
+                for host in data[group].get('hosts', []):
+                    expected_inventory.add_host(host, group=group)
+                    for key, value in data['_meta']['hostvars'][host].items():
+                        expected_inventory.set_variable(host, key, value)
+                expected_inventory.add_child('all', group)
+
+        jenkins_inventory.inventory = InventoryData()
+        with patch.object(jenkins_inventory.inventory, 'set_variable',
+                          wraps=jenkins_inventory.inventory.set_variable) as set_variable_mock:
+            jenkins_inventory._data_2_inventory(data)
+
+        variables_set = [call[0][:2] for call in set_variable_mock.call_args_list]
+        self.assertEqual(len(variables_set), len(set(variables_set)))
+        for host, host_vars in data['_meta']['hostvars'].items():
+            for key in host_vars:
+                self.assertIn((host, key), variables_set)
+        self.assertEqual(self.inventory_content(jenkins_inventory.inventory),
+                         self.inventory_content(expected_inventory))
+
+
+class JenkinsInventory_Composed_Tests(TestCase):
+
+    def get_inventory(self, data, **options):
+        jenkins_inventory = InventoryModule()
+        jenkins_inventory._options.update({'strict': False,
+                                           'use_extra_vars': False,
+                                           'leading_separator': True})
+        jenkins_inventory._options.update(options)
+        jenkins_inventory.templar = Templar(loader=DataLoader())
+        jenkins_inventory.inventory = InventoryData()
+        jenkins_inventory._data_2_inventory(data)
+        return jenkins_inventory
+
+    def test_memoized_same_as_evaluated(self):
+        '''
+        Tests that the hosts sharing the variables read by the expressions
+            get the inventory we get evaluating them for every host.
+        '''
+        with FakeJenkins(nodes=30) as jenkins:
+            data = self.get_inventory({}, jenkins_host=jenkins.url).get_data_from_jenkins()
+
+        options = {'compose': {'ssh': "launcher_plugin.startswith('ssh')",
+                               'executors': 'num_executors * 2',
+                               'flags': "[FLAG, offline]"},
+                   'groups': {'available': 'not offline and not temporary_offline',
+                              'windows': "launcher_plugin.startswith('windows')"},
+                   'keyed_groups': [{'key': 'launcher_plugin.split("@")[0]', 'prefix': 'plugin'},
+                                    {'key': "'yes' if idle else 'no'", 'prefix': 'idle', 'parent_group': 'states'},
+                                    {'key': 'flags | map("string") | list', 'prefix': 'flag'}]}
+
+        # As they are when read from the inventory file
+        options = {'compose': dict((name, trust_as_template(value)) for name, value in options['compose'].items()),
+                   'groups': dict((name, trust_as_template(value)) for name, value in options['groups'].items()),
+                   'keyed_groups': [dict((name, trust_as_template(value)) for name, value in keyed.items())
+                                    for keyed in options['keyed_groups']]}
+
+        memoized = self.get_inventory(data, **options)
+        with patch.object(memoized, '_add_composed_host', wraps=memoized._add_composed_host) as evaluate_mock:
+            memoized._add_composed_hostvars()
+        # 3 launchers x idle x offline x temporarily offline at most
+        self.assertLessEqual(evaluate_mock.call_count, 24)
+
+        evaluated = self.get_inventory(data, **options)
+        with patch('jenkins.constructed_variables', return_value=None):
+            evaluated._add_composed_hostvars()
+
+        inventory_content = JenkinsInventory_Inventory_Tests.inventory_content
+        self.assertEqual(inventory_content(None, memoized.inventory), inventory_content(None, evaluated.inventory))
+        self.assertIn('windows', memoized.inventory.groups)
+        self.assertIn('states', memoized.inventory.groups)
+        self.assertEqual(memoized.inventory.get_host('node3').get_vars()['executors'], 2)
+
+    def test_not_memoized(self):
+        '''
+        Tests that the expressions reading every variable or giving random
+            results are evaluated for every host.
+        '''
+        self.assertEqual(constructed_variables({'a': 'ENV_INDEX | int + 1'}, {'b': 'idle'},
+                                               [{'key': 'x', 'parent_group': '{{ y }}'}]),
+                         set(['ENV_INDEX', 'idle', 'x', 'y']))
+        self.assertEqual(constructed_variables({'a': "('indows' in launcher_plugin) | ternary('winrm', 'ssh')"}, {}, []),
+                         set(['launcher_plugin']))
+        self.assertIsNone(constructed_variables({'a': 'hostvars[inventory_hostname].idle'}, {}, []))
+        self.assertIsNone(constructed_variables({'a': '100 | random'}, {}, []))
+        self.assertIsNone(constructed_variables({}, {'a': "lookup('env', 'HOME')"}, []))
+        self.assertIsNone(constructed_variables({}, {'a': '{{ not valid'}, []))
+
+
+class JenkinsInventory_LabelGroups_Tests(TestCase):
+
+    def test_label_expressions(self):
+        '''
+        Tests the operators, their precedence and the invalid expressions,
+            chained -> and <-> included.
+        '''
+        label_groups = LabelGroups({'docker_cpu': 'linux && docker && !gpu',
+                                    'desktop': 'win || mac',
+                                    'quoted': '(win || mac) && "big disk"',
+                                    'implies': 'gpu -> (cuda-11 -> docker)',
+                                    'iff': 'win <-> mac || linux && !docker'})
+        self.assertEqual(label_groups.matching(('linux', 'docker')), ['docker_cpu', 'implies', 'iff'])
+        self.assertEqual(label_groups.matching(('linux', 'docker', 'gpu')), ['implies', 'iff'])
+        self.assertEqual(label_groups.matching(('linux', 'gpu')), ['implies'])
+        self.assertEqual(label_groups.matching(('gpu', 'cuda-11')), ['iff'])
+        self.assertEqual(label_groups.matching(('mac', 'big disk', 'unused')), ['desktop', 'quoted', 'implies'])
+        self.assertEqual(label_groups.matching(('gpu', 'cuda-11', 'docker')), ['implies', 'iff'])
+        self.assertEqual(label_groups.label_bits(('unused', 'other')), 0)
+
+        self.assertEqual(LabelGroups({'mixed': 'gpu -> docker <-> linux'}).matching(('gpu', 'linux')), [])
+
+        for expression in ('', 'linux &&', '(linux', 'linux docker', 'linux)', '&& linux', 'linux->',
+                           'gpu -> cuda-11 -> docker', 'win <-> mac <-> linux'):
+            with self.assertRaises(AnsibleError):
+                LabelGroups({'group': expression})
+
+    def parse(self, jenkins, cache, **options):
+        jenkins_inventory = InventoryModule()
+        jenkins_inventory._cache = cache
+        options = dict({'jenkins_host': jenkins.url, 'cache': True}, **options)
+        with patch.object(jenkins_inventory, '_read_config_data',
+                          side_effect=lambda path: jenkins_inventory._options.update(options)), \
+                patch.object(jenkins_inventory, 'get_cache_key', return_value=CACHE_TEST_KEY):
+            jenkins_inventory.parse(InventoryData(), DataLoader(), 'test.jenkins.yml')
+        return jenkins_inventory
+
+    def group_hosts(self, jenkins_inventory, group):
+        return sorted(host.name for host in jenkins_inventory.inventory.groups[group].get_hosts())
+
+    @patch.object(InventoryModule, '_must_login', return_value=False)
+    def test_label_groups(self, _must_login_mock):
+        '''
+        Tests that the computers are added to the groups of the expressions
+            they match, their names and computers with the same labels
+            evaluated once, and the cached data evaluated again.
+        '''
+        for cache_format in ('json', 'compact'):
+            cache = CachePluginAdjudicator(plugin_name='memory')
+            with FakeJenkins(nodes=20, labels=2) as jenkins:
+                jenkins_inventory = self.parse(jenkins, cache, cache_format=cache_format,
+                                               label_groups={'first': 'label0 || label1',
+                                                             'no_tag': '!tag1',
+                                                             'linux': 'label1',
+                                                             'tagged': 'linux && tag0 && tag1',
+                                                             'named': 'node3 || (node5 && linux)'})
+                requests = jenkins.count()
+                self.assertEqual(self.group_hosts(jenkins_inventory, 'first'), ['node0', 'node1'])
+                self.assertNotIn('no_tag', jenkins_inventory.inventory.groups)
+                self.assertEqual(len(self.group_hosts(jenkins_inventory, 'linux')), 20)
+                self.assertEqual(len(self.group_hosts(jenkins_inventory, 'tagged')), 20)
+                self.assertEqual(self.group_hosts(jenkins_inventory, 'named'), ['node3', 'node5'])
+                # label0, label1, node3, node5 and any other computer
+                self.assertEqual(len(jenkins_inventory._label_groups._matching), 5)
+
+                # The cached data has only the labels
+                data = jenkins_inventory._get_cached_data(CACHE_TEST_KEY)
+                if cache_format == 'compact':
+                    data = data.to_data()
+                self.assertNotIn('first', data)
+
+                jenkins_inventory = self.parse(jenkins, cache, cache_format=cache_format,
+                                               label_groups={'second': 'label2 && !tag1 || node4'})
+                self.assertEqual(jenkins.count(), requests)
+                self.assertEqual(self.group_hosts(jenkins_inventory, 'second'), ['node4'])
+                self.assertNotIn('first', jenkins_inventory.inventory.groups)
+
+
+class JenkinsInventory_ConfigXml_Tests(TestCase):
+
+    def test_extract_same_as_objectify(self):
+        '''
+        Tests that the streaming extraction reads exactly what we read
+            from the objectify tree, objectify type guessing included.
+        '''
+        jenkins_inventory = InventoryModule()
+        configs = [fake_config_xml('node{0}'.format(index), 2, 2) for index in range(30)]
+        configs.append(b'''<slave>
+  <launcher plugin="ssh-slaves@1.26"><host>1E5</host><port>022</port></launcher>
+  <launcher plugin="other@1.0"><host>ignored</host></launcher>
+  <label> true  007 tag</label>
+  <nodeProperties>
+    <hudson.slaves.EnvironmentVariablesNodeProperty>
+      <envVars><tree-map><int>2</int>
+        <string>EMPTY</string><string/><string>HALF</string><string>.5</string>
+      </tree-map></envVars>
+    </hudson.slaves.EnvironmentVariablesNodeProperty>
+  </nodeProperties>
+  <temporaryOfflineCause/>
+</slave>''')
+
+        for config in configs:
+            self.assertEqual(extract_computer_config(config),
+                             jenkins_inventory._computer_info_2_record(objectify.fromstring(config)))
+
+    def test_unusual_config_fallback(self):
+        '''
+        Tests that objectify reads the configurations we can't stream.
+        '''
+        config = b'<slave><label>linux<x/></label><launcher plugin="ssh-slaves@1.26"/></slave>'
+
+        self.assertRaises(ValueError, extract_computer_config, config)
+
+        jenkins_inventory = InventoryModule()
+        record = jenkins_inventory._parse_computer_config('node', config)
+        self.assertEqual(record.labels, ('linux',))
+        self.assertEqual(record.launcher_plugin, 'ssh-slaves@1.26')
+
+
+class JenkinsInventory_Record_Tests(TestCase):
+
+    def test_records_share_strings(self):
+        '''
+        Tests that the records of different computers share the repeated
+            strings of the table of their run, and only them, and that they
+            go through the node cache unchanged.
+        '''
+        texts = {}
+        first = extract_computer_config(fake_config_xml('node1', 2, 2), texts)
+        second = extract_computer_config(fake_config_xml('node2', 2, 2), texts)
+        self.assertIs(first.launcher_plugin, second.launcher_plugin)
+        self.assertIs(first.labels[-1], second.labels[-1])
+        self.assertIs(first.properties[-1], second.properties[-1])
+        other_run = extract_computer_config(fake_config_xml('node1', 2, 2), {})
+        self.assertIsNot(other_run.launcher_plugin, first.launcher_plugin)
+        self.assertIs(texts[first.launcher_plugin], first.launcher_plugin)
+
+        self.assertEqual(ComputerRecord.from_state(json.loads(json.dumps(first.to_state()))), first)
+        legacy_state = {'labels': ['linux', 'label1', 'tag0', 'tag1'],
+                        'launcher_plugin': 'ssh-slaves@1.26',
+                        'ansible_host': '10.0.0.1',
+                        'ansible_port': '22',
+                        'temporary_offline': False,
+                        'properties': dict(zip(first.properties[::2], first.properties[1::2]))}
+        self.assertEqual(ComputerRecord.from_state(legacy_state), first)
+
+        first.set_state(fake_computers(2)[2])
+        host_vars = first.host_vars()
+        self.assertEqual(list(host_vars)[:3], ['launcher_plugin', 'inventory_hostname', 'ansible_host'])
+        self.assertEqual(host_vars['VAR1'], 'value1')
+        self.assertNotIn('jenkins_stale', host_vars)
+        self.assertTrue(first.stale_copy().set_state(fake_computers(2)[2]).host_vars()['jenkins_stale'])
+
+
+class JenkinsInventory_NodeCache_Tests(JenkinsTestCase):
+
+    def fake_config_response(self, computer_name, headers):
+        # Odd computers answer "not modified" when we already have them
+        if headers.get('If-None-Match') and int(computer_name.replace('node', '')) % 2:
+            return JenkinsResponse(computer_name, 304, 'Not Modified', {}, b'')
+        return JenkinsResponse(computer_name, 200, 'OK',
+                               {'ETag': '"{0}"'.format(computer_name)},
+                               fake_config_xml(computer_name))
+
+    @patch.object(InventoryModule, '_must_login', return_value=False)
+    @patch.object(InventoryModule, '_parse_computer_config',
+                  autospec=True, side_effect=InventoryModule._parse_computer_config)
+    @patch.object(InventoryModule, '_request_computer_config')
+    @patch.object(InventoryModule, '_get_all_computers')
+    def test_node_cache_refresh(self,
+                                _get_all_computers_mock,
+                                _request_computer_config_mock,
+                                _parse_computer_config_mock,
+                                _must_login_mock):
+        '''
+        Tests that a refresh only parses the changed computers, keeps the
+            data the same and drops the computers that no longer exist.
+        '''
+        _request_computer_config_mock.side_effect = self.fake_config_response
+
+        jenkins_inventory = InventoryModule()
+        jenkins_inventory._options['node_cache'] = True
+        jenkins_inventory._options['state_dir'] = self.state_dir
+
+        _get_all_computers_mock.return_value = fake_computers(10)
+        first_data = jenkins_inventory.get_data_from_jenkins()
+        self.assertEqual(_parse_computer_config_mock.call_count, 10)
+
+        _parse_computer_config_mock.reset_mock()
+        second_data = jenkins_inventory.get_data_from_jenkins()
+        # Unmodified (304) and unchanged (same digest) computers are not parsed
+        _parse_computer_config_mock.assert_not_called()
+        self.assertEqual(first_data, second_data)
+        self.assertEqual(_request_computer_config_mock.call_args[0][1]['If-None-Match'], '"node9"')
+
+        _get_all_computers_mock.return_value = fake_computers(5)
+        jenkins_inventory.get_data_from_jenkins()
+        jenkins_inventory._load_node_cache()
+        self.assertEqual(sorted(jenkins_inventory._node_cache),
+                         ['node{0}'.format(index) for index in range(5)])
+
+    def test_node_cache_not_modified(self):
+        '''
+        Tests that jenkins answers "not modified" to the computers we
+            already have, and the changed ones are read again, with both
+            engines.
+        '''
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=10, etags=True) as jenkins:
+                def get_inventory():
+                    return self.get_inventory(jenkins.url, engine=engine, max_workers=4, node_cache=True,
+                                              state_dir=os.path.join(self.state_dir, engine))
+
+                jenkins_inventory = get_inventory()
+                first_data = jenkins_inventory.get_data_from_jenkins()
+                self.assertEqual(jenkins_inventory._metrics.counters['node_cache_misses'], 10)
+
+                jenkins.requests = []
+                jenkins_inventory = get_inventory()
+                self.assertEqual(jenkins_inventory.get_data_from_jenkins(), first_data)
+                self.assertEqual(jenkins_inventory._metrics.counters['node_cache_hits'], 10)
+                self.assertEqual(len([request for request in jenkins.requests if request[3].get('If-None-Match')]), 10)
+
+                # Every config.xml changes
+                jenkins.labels = 1
+                jenkins_inventory = get_inventory()
+                data = jenkins_inventory.get_data_from_jenkins()
+                self.assertEqual(jenkins_inventory._metrics.counters['node_cache_misses'], 10)
+                self.assertEqual(len(data['tag0']['hosts']), 10)
+
+
+class JenkinsInventory_FetchMode_Tests(JenkinsTestCase):
+
+    def get_data(self, jenkins, fetch_mode, jsessionid=False, **options):
+        options = dict({'jenkins_user': 'user', 'jenkins_pass': 'pass',
+                        'jenkins_jsessionid': jsessionid, 'fetch_mode': fetch_mode}, **options)
+        return super(JenkinsInventory_FetchMode_Tests, self).get_data(jenkins, **options)
+
+    def test_script_mode_data_is_the_same(self):
+        '''
+        Tests that the script mode gets everything in one request and
+            builds exactly the same data as reading every config.xml.
+        '''
+        with FakeJenkins(nodes=30, labels=2, env_vars=2) as jenkins:
+            config_data = self.get_data(jenkins, 'config')
+            self.assertEqual(jenkins.count('/computer/'), 31)
+
+            script_data = self.get_data(jenkins, 'script', jsessionid=True)
+            self.assertEqual(jenkins.count('/scriptText'), 1)
+            self.assertEqual(jenkins.count('/computer/'), 31)
+
+        self.assertEqual(config_data, script_data)
+        self.assertEqual(script_data['_meta']['hostvars']['node3']['FLAG'], 'True')
+
+    def test_script_mode_fallback(self):
+        '''
+        Tests that the config.xml files are read when the user is not
+            allowed to run scripts.
+        '''
+        with FakeJenkins(nodes=5, allow_script=False) as jenkins:
+            data = self.get_data(jenkins, 'script')
+            self.assertEqual(jenkins.count('/scriptText'), 1)
+            self.assertEqual(jenkins.count('/computer/'), 6)
+
+        self.assertEqual(len(data['_meta']['hostvars']), 5)
+
+    def test_script_mode_crumb(self):
+        '''
+        Tests that the script is sent with the crumb of its session with a
+            password, jsessionid or not, but not with an api token, and that
+            a cached session jenkins forgot logs in again instead of falling
+            back to the config.xml files.
+        '''
+        with FakeJenkins(nodes=5, crumbs=True) as jenkins:
+            for jsessionid in (False, True):
+                data = self.get_data(jenkins, 'script', jsessionid=jsessionid)
+                self.assertEqual(len(data['_meta']['hostvars']), 5)
+            self.assertEqual(jenkins.count('/crumbIssuer/'), 2)
+
+            self.get_data(jenkins, 'script', jenkins_pass='11' + '0123456789abcdef' * 2)
+            self.assertEqual(jenkins.count('/crumbIssuer/'), 2)
+
+            self.get_data(jenkins, 'script', jsessionid=True, jsessionid_cache=True)
+            jenkins.forget_sessions()
+            data = self.get_data(jenkins, 'script', jsessionid=True, jsessionid_cache=True)
+            self.assertEqual(len(data['_meta']['hostvars']), 5)
+            self.assertEqual(jenkins.count('/j_acegi_security_check'), 3)
+            self.assertEqual(jenkins.count('/crumbIssuer/'), 5)
+            self.assertEqual(jenkins.count('/scriptText'), 5)
+            self.assertEqual(jenkins.count('/computer/'), 0)
+
+    def test_filters(self):
+        '''
+        Tests that the filtered computers are left out before reading
+            their config.xml, in both fetch modes.
+        '''
+        filters = {'include': {'labels': ['label3', 'label5', 'label7', 'label8'],
+                               'state': ['online']},
+                   'exclude': {'names': ['^node7$']}}
+
+        with FakeJenkins(nodes=30) as jenkins:
+            config_data = self.get_data(jenkins, 'config', **filters)
+            self.assertEqual(jenkins.count('/computer/'), 3)
+            self.assertIn('assignedLabels[name]', jenkins.requests[0][2])
+
+            script_data = self.get_data(jenkins, 'script', **filters)
+
+        self.assertEqual(sorted(config_data['_meta']['hostvars']), ['node5', 'node8'])
+        self.assertEqual(config_data, script_data)
+
+
+class JenkinsInventory_Engine_Tests(JenkinsTestCase):
+
+    def get_data(self, jenkins, **options):
+        return super(JenkinsInventory_Engine_Tests, self).get_data(jenkins, **dict(LOGIN_OPTIONS, max_workers=8, **options))
+
+    def test_async_data_is_the_same(self):
+        '''
+        Tests that the async engine builds exactly the same data as
+            the threads one, with and without chunked answers.
+        '''
+        for chunked in (False, True):
+            with FakeJenkins(nodes=50, labels=2, env_vars=2, chunked=chunked) as jenkins:
+                threads_data = self.get_data(jenkins, engine='threads')
+                async_data = self.get_data(jenkins, engine='async', exclude={'state': ['busy']})
+                async_cached_data = self.get_data(jenkins, engine='async', exclude={'state': ['busy']},
+                                                  node_cache=True)
+                self.assertEqual(jenkins.count('/computer/'), 51 + 26 + 26)
+
+            for host in list(threads_data['_meta']['hostvars']):
+                if not threads_data['_meta']['hostvars'][host]['idle']:
+                    del threads_data['_meta']['hostvars'][host]
+            self.assertEqual(threads_data['_meta'], async_data['_meta'])
+            self.assertEqual(async_data, async_cached_data)
+
+
+class JenkinsInventory_Pipeline_Tests(TestCase):
+
+    def parse(self, jenkins, engine):
+        jenkins_inventory = InventoryModule()
+        options = {'jenkins_host': jenkins.url,
+                   'max_workers': 4,
+                   'engine': engine,
+                   'strict': False,
+                   'use_extra_vars': False,
+                   'leading_separator': True,
+                   'compose': {'executors': trust_as_template('num_executors * 2')},
+                   'keyed_groups': [{'key': trust_as_template('launcher_plugin.split("@")[0]'), 'prefix': 'plugin'}]}
+        added = []
+
+        def add_computer_2_inventory(computer_name, groups, data):
+            added.append(time.time())
+            InventoryModule._add_computer_2_inventory(jenkins_inventory, computer_name, groups, data)
+
+        with patch.object(jenkins_inventory, '_read_config_data',
+                          side_effect=lambda path: jenkins_inventory._options.update(options)), \
+                patch.object(jenkins_inventory, '_add_computer_2_inventory', side_effect=add_computer_2_inventory), \
+                patch.object(jenkins_inventory, '_write_cache') as write_cache_mock:
+            jenkins_inventory.parse(InventoryData(), DataLoader(), 'test.jenkins.yml', cache=False)
+        return jenkins_inventory, write_cache_mock.call_args[0][2], added, time.time()
+
+    def test_pipeline_same_inventory(self):
+        '''
+        Tests that the computers are added to the inventory while the
+            slow ones are read, and the inventory and the data to cache
+            are the same we get adding them at the end.
+        '''
+        inventory_content = JenkinsInventory_Inventory_Tests.inventory_content
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=30, slow_nodes=('node29',), slow_latency=1.0) as jenkins:
+                pipelined, data, added, end = self.parse(jenkins, engine)
+                jenkins.slow_nodes = ()
+                _, expected_data, _, _ = self.parse(jenkins, 'threads')
+
+            self.assertEqual(len(added), 30)
+            self.assertLess(added[0], end - 0.5)
+            self.assertEqual(data, expected_data)
+
+            expected = InventoryModule()
+            expected._options.update(pipelined._options)
+            expected.templar = pipelined.templar
+            expected.inventory = InventoryData()
+            expected._data_2_inventory(data)
+            expected._add_composed_hostvars()
+            self.assertEqual(inventory_content(None, pipelined.inventory), inventory_content(None, expected.inventory))
+            self.assertEqual(pipelined.inventory.get_host('node3').get_vars()['executors'], 2)
+            self.assertIn('plugin_ssh_slaves', pipelined.inventory.groups)
+
+
+class JenkinsInventory_Overload_Tests(TestCase):
+
+    def test_aimd_limiter(self):
+        '''
+        Tests that the limiter grows while jenkins is fast, halves when
+            it is slow or fails, and stays between 1 and the maximum.
+        '''
+        limiter = AIMDLimiter(8, adaptive=True, target_latency=0.5)
+        self.assertEqual(int(limiter.limit), 1)
+
+        for _ in range(20):
+            limiter._update(0.1, True)
+        self.assertEqual(int(limiter.limit), 8)
+
+        limiter._update(0.9, True)
+        self.assertEqual(int(limiter.limit), 4)
+        # Only once per target latency
+        limiter._update(0.1, False)
+        self.assertEqual(int(limiter.limit), 4)
+
+        limiter._last_decrease = 0
+        limiter._update(0.1, False)
+        self.assertEqual(int(limiter.limit), 2)
+
+        # Additive increase from now on
+        limiter._update(0.1, True)
+        self.assertEqual(limiter.limit, 2.5)
+
+        fixed_limiter = AIMDLimiter(8)
+        fixed_limiter._update(10, False)
+        self.assertEqual(fixed_limiter.limit, 8)
+
+    def test_retries(self):
+        '''
+        Tests that the requests answered with 503 are retried, with
+            both engines, and that they fail once the retries run out.
+        '''
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=20, busy=10) as jenkins:
+                jenkins_inventory = InventoryModule()
+                jenkins_inventory._options.update({'jenkins_host': jenkins.url,
+                                                   'max_workers': 4,
+                                                   'engine': engine,
+                                                   'adaptive_concurrency': True,
+                                                   'retries': 10})
+                data = jenkins_inventory.get_data_from_jenkins()
+                self.assertEqual(len(data['_meta']['hostvars']), 20)
+                self.assertEqual(jenkins.count('/computer/'), 31)
+
+                jenkins.busy = 1
+                jenkins_inventory._options['retries'] = 0
+                self.assertRaises(JenkinsHTTPError, jenkins_inventory.get_data_from_jenkins)
+
+    def test_retried_requests(self):
+        '''
+        Tests that only the GET requests are retried, and the ones that
+            timed out only when asked to, with both sessions.
+        '''
+        def request_sync(jenkins, method, path, **options):
+            return JenkinsSession(jenkins.url, timeout=0.2, retries=2, **options).request(method, path)
+
+        async def request_async_session(jenkins, method, path, **options):
+            session = AsyncJenkinsSession(jenkins.url, timeout=0.2, retries=2, limiter=AsyncAdaptiveLimiter(1), **options)
+            try:
+                return await session.request(method, path)
+            finally:
+                session.close()
+
+        def request_async(jenkins, method, path, **options):
+            return asyncio.run(request_async_session(jenkins, method, path, **options))
+
+        for request in (request_sync, request_async):
+            with FakeJenkins(nodes=1, latency=0.3) as jenkins:
+                for method, path, options, count in (('GET', 'computer/api/json', {}, 1),
+                                                     ('GET', 'computer/api/json', {'retry_timeouts': True}, 3),
+                                                     ('POST', 'scriptText', {'retry_timeouts': True}, 1)):
+                    jenkins.requests = []
+                    with self.assertRaises(AnsibleError):
+                        request(jenkins, method, path, **options)
+                    self.assertEqual(len(jenkins.requests), count)
+
+
+class JenkinsInventory_Session_Tests(JenkinsTestCase):
+
+    def test_cached_jsessionid(self):
+        '''
+        Tests that the jsessionid is reused between runs, and that we
+            login again when jenkins forgets it or it's too old.
+        '''
+        with FakeJenkins(nodes=5) as jenkins:
+            def get_data(**options):
+                return self.get_data(jenkins, jsessionid_cache=True, **dict(LOGIN_OPTIONS, **options))
+
+            first_data = get_data()
+            self.assertEqual(get_data(), first_data)
+            self.assertEqual(jenkins.count('/j_acegi_security_check'), 1)
+
+            jenkins.forget_sessions()
+            self.assertEqual(get_data(fetch_mode='script'), first_data)
+            self.assertEqual(get_data(), first_data)
+            self.assertEqual(jenkins.count('/j_acegi_security_check'), 2)
+
+            self.assertEqual(get_data(jsessionid_ttl=0), first_data)
+            self.assertEqual(jenkins.count('/j_acegi_security_check'), 3)
+
+            session_file = os.path.join(self.state_dir, os.listdir(self.state_dir)[0])
+            self.assertEqual(os.stat(session_file).st_mode & 0o777, 0o600)
+
+    def test_connection_reuse(self):
+        '''
+        Tests that every request goes through the same keep-alive
+            connection, and that a new one is opened when jenkins closed
+            the idle one.
+        '''
+        with FakeJenkins(nodes=5) as jenkins:
+            for engine in ('threads', 'async'):
+                jenkins.requests = []
+                self.get_data(jenkins, max_workers=1, engine=engine)
+                self.assertEqual(len(jenkins.requests), 6)
+                self.assertEqual(len(set(request[4] for request in jenkins.requests)), 1)
+
+            def request_twice(session):
+                session.request('GET', 'computer/api/json')
+                jenkins.close_connections()
+                return session.request('GET', 'computer/api/json')
+
+            async def request_twice_async():
+                session = AsyncJenkinsSession(jenkins.url, limiter=AsyncAdaptiveLimiter(1))
+                await session.request('GET', 'computer/api/json')
+                jenkins.close_connections()
+                response = await session.request('GET', 'computer/api/json')
+                session.close()
+                return response
+
+            for get_response in (lambda: request_twice(JenkinsSession(jenkins.url)),
+                                 lambda: asyncio.run(request_twice_async())):
+                jenkins.requests = []
+                self.assertEqual(get_response().status, 200)
+                self.assertEqual(len(jenkins.requests), 2)
+                self.assertEqual(len(set(request[4] for request in jenkins.requests)), 2)
+
+    def test_not_modified(self):
+        '''
+        Tests that both sessions give back the 304 answer of a conditional
+            request, it is not an error.
+        '''
+        with FakeJenkins(nodes=1, etags=True, chunked=True) as jenkins:
+            def request_twice(session):
+                etag = session.request('GET', 'computer/node0/config.xml').headers['ETag']
+                return session.request('GET', 'computer/node0/config.xml', headers={'If-None-Match': etag})
+
+            async def request_twice_async():
+                session = AsyncJenkinsSession(jenkins.url, limiter=AsyncAdaptiveLimiter(1))
+                response = await session.request('GET', 'computer/node0/config.xml')
+                response = await session.request('GET', 'computer/node0/config.xml',
+                                                 headers={'If-None-Match': response.headers['ETag']})
+                session.close()
+                return response
+
+            for get_response in (lambda: request_twice(JenkinsSession(jenkins.url)),
+                                 lambda: asyncio.run(request_twice_async())):
+                response = get_response()
+                self.assertEqual(response.status, 304)
+                self.assertEqual(response.read(), b'')
+
+    def test_auth_headers(self):
+        '''
+        Tests that the requests carry the jsessionid cookie after the
+            login, or the basic auth credentials without it.
+        '''
+        credentials = 'Basic {0}'.format(base64.b64encode(b'user:pass').decode('ascii'))
+        for engine in ('threads', 'async'):
+            for jsessionid in (True, False):
+                with FakeJenkins(nodes=3) as jenkins:
+                    self.get_data(jenkins, engine=engine, **dict(LOGIN_OPTIONS, jenkins_jsessionid=jsessionid))
+
+                    requests = [request for request in jenkins.requests if request[0] == 'GET']
+                    self.assertEqual(len(requests), 4)
+                    for request in requests:
+                        if jsessionid:
+                            self.assertEqual(request[3].get('Cookie'), jenkins.sessions[0])
+                            self.assertNotIn('Authorization', request[3])
+                        else:
+                            self.assertEqual(request[3].get('Authorization'), credentials)
+                            self.assertNotIn('Cookie', request[3])
+
+    def test_redirections(self):
+        '''
+        Tests that the GET requests follow a jenkins moved to another
+            port (as from http to https), only the first one redirected.
+        '''
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=5) as jenkins, FakeJenkins(redirect_to=jenkins.url) as moved:
+                jenkins_inventory = self.get_inventory(moved.url, max_workers=2, engine=engine)
+                data = jenkins_inventory.get_data_from_jenkins()
+                self.assertEqual(len(data['_meta']['hostvars']), 5)
+                self.assertEqual(moved.count(), 1)
+                self.assertEqual(jenkins.count(), 6)
+
+                # A redirection loop is not followed forever
+                jenkins.redirect_to = moved.url
+                moved.redirect_to = jenkins.url
+                self.assertRaises(JenkinsHTTPError, jenkins_inventory.get_data_from_jenkins)
+
+
+class JenkinsInventory_CompactCache_Tests(TestCase):
+
+    def test_compact_same_inventory(self):
+        '''
+        Tests that the compact cache builds the same inventory, and that
+            caches of another format or schema are not used.
+        '''
+        with FakeJenkins(nodes=30, labels=2, env_vars=3) as jenkins:
+            jenkins_inventory = InventoryModule()
+            jenkins_inventory._options.update({'jenkins_host': jenkins.url, 'cache_format': 'compact'})
+            data = jenkins_inventory.get_data_from_jenkins()
+
+        fake_cache = {}
+        jenkins_inventory._cache = MagicMock()
+        jenkins_inventory._cache.set.side_effect = fake_cache.__setitem__
+        jenkins_inventory._cache.get.side_effect = fake_cache.__getitem__
+        jenkins_inventory._set_cached_data(CACHE_TEST_KEY, data)
+        self.assertLess(len(json.dumps(fake_cache[CACHE_TEST_KEY])), len(json.dumps(data)) / 4)
+
+        compact = jenkins_inventory._get_cached_data(CACHE_TEST_KEY)
+        self.assertIsInstance(compact, CompactData)
+        inventory_content = JenkinsInventory_Inventory_Tests.inventory_content
+        jenkins_inventory.inventory = InventoryData()
+        jenkins_inventory._data_2_inventory(compact)
+        expected_inventory = InventoryModule()
+        expected_inventory.inventory = InventoryData()
+        expected_inventory._data_2_inventory(data)
+        self.assertEqual(inventory_content(None, jenkins_inventory.inventory),
+                         inventory_content(None, expected_inventory.inventory))
+
+        # Written by json, or by another schema
+        jenkins_inventory._options['cache_format'] = 'json'
+        self.assertRaises(KeyError, jenkins_inventory._get_cached_data, CACHE_TEST_KEY)
+        fake_cache[CACHE_TEST_KEY] = data
+        self.assertEqual(jenkins_inventory._get_cached_data(CACHE_TEST_KEY), data)
+        jenkins_inventory._options['cache_format'] = 'compact'
+        self.assertRaises(KeyError, jenkins_inventory._get_cached_data, CACHE_TEST_KEY)
+        fake_cache[CACHE_TEST_KEY] = dict(encode_compact_data(data), jenkins_inventory_cache=0)
+        self.assertRaises(KeyError, jenkins_inventory._get_cached_data, CACHE_TEST_KEY)
+
+
+class JenkinsInventory_Snapshot_Tests(JenkinsTestCase):
+
+    def setUp(self):
+        super(JenkinsInventory_Snapshot_Tests, self).setUp()
+        self.snapshot_path = os.path.join(self.state_dir, 'snapshots', 'jenkins.snapshot')
+
+    def test_snapshot(self):
+        '''
+        Tests that the entry point writes a snapshot with the data read from
+            jenkins, and that a host is read from its index.
+        '''
+        with FakeJenkins(nodes=30) as jenkins:
+            inventory_path = os.path.join(self.state_dir, 'test.jenkins.yml')
+            with open(inventory_path, 'w') as inventory_file:
+                inventory_file.write('plugin: jenkins\njenkins_host: {0}\nsnapshot_path: {1}\n'.format(
+                    jenkins.url, self.snapshot_path))
+            self.assertEqual(jenkins_main([inventory_path]), 0)
+            data = self.get_data(jenkins)
+
+        self.assertEqual(read_snapshot(self.snapshot_path), data)
+        self.assertEqual(read_snapshot_host(self.snapshot_path, 'node3'), data['_meta']['hostvars']['node3'])
+        self.assertIsNone(read_snapshot_host(self.snapshot_path, 'node30'))
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout_mock:
+            self.assertEqual(jenkins_main(['--snapshot', self.snapshot_path, '--host', 'node29']), 0)
+        self.assertEqual(json.loads(stdout_mock.getvalue()), data['_meta']['hostvars']['node29'])
+
+        write_snapshot(self.snapshot_path, InventoryModule()._init_empty_inventory())
+        self.assertEqual(read_snapshot(self.snapshot_path), InventoryModule()._init_empty_inventory())
+        with open(self.snapshot_path, 'w') as snapshot_file:
+            snapshot_file.write('{}')
+        with self.assertRaises(AnsibleError):
+            read_snapshot_host(self.snapshot_path, 'node3')
+
+    @patch.object(InventoryModule, 'get_data_from_jenkins')
+    def test_parse_snapshot(self, get_data_from_jenkins_mock):
+        '''
+        Tests that the inventory is read from the snapshot, not from jenkins.
+        '''
+        with FakeJenkins(nodes=10) as jenkins:
+            data = self.get_inventory(jenkins.url)._get_data_from_jenkins()
+        # As it is in a compact cache
+        write_snapshot(self.snapshot_path, decode_compact_data(encode_compact_data(data)))
+
+        jenkins_inventory = InventoryModule()
+        with patch.object(jenkins_inventory, '_read_config_data',
+                          side_effect=lambda path: jenkins_inventory._options.update(snapshot_path=self.snapshot_path)):
+            jenkins_inventory.parse(InventoryData(), DataLoader(), 'test.jenkins.yml', cache=False)
+
+        get_data_from_jenkins_mock.assert_not_called()
+        self.assertEqual(sorted(jenkins_inventory.inventory.hosts), sorted(data['_meta']['hostvars']))
+        self.assertEqual(jenkins_inventory.inventory.get_host('node3').get_vars()['ENV_INDEX'], '3')
+
+
+class JenkinsInventory_Masters_Tests(TestCase):
+
+    def get_inventory(self, masters, **options):
+        jenkins_inventory = InventoryModule()
+        jenkins_inventory._options.update({'masters': masters, 'max_workers': 2})
+        jenkins_inventory._options.update(options)
+        return jenkins_inventory
+
+    def test_masters_merged(self):
+        '''
+        Tests that the computers of every master are merged, keeping the
+            first one or prefixing them, and grouped by master.
+        '''
+        with FakeJenkins(nodes=5) as first, FakeJenkins(nodes=8, env_vars=1) as second:
+            masters = [{'name': 'first', 'jenkins_host': first.url},
+                       {'name': 'second', 'jenkins_host': second.url, 'max_workers': 4}]
+
+            data = self.get_inventory(masters, master_groups=True).get_data_from_jenkins()
+            hostvars = data['_meta']['hostvars']
+            self.assertEqual(len(hostvars), 8)
+            self.assertEqual(hostvars['node3']['jenkins_master'], 'first')
+            self.assertNotIn('VAR0', hostvars['node3'])
+            self.assertEqual(hostvars['node6']['jenkins_master'], 'second')
+            self.assertEqual(len(data['linux']['hosts']), 8)
+            self.assertEqual(len(data['first']['hosts']), 5)
+            self.assertEqual(len(data['second']['hosts']), 8)
+            self.assertIn('second', data['all']['children'])
+
+            data = self.get_inventory(masters, master_hosts='prefix').get_data_from_jenkins()
+            hostvars = data['_meta']['hostvars']
+            self.assertEqual(len(hostvars), 13)
+            self.assertEqual(hostvars['second_node3']['VAR0'], 'value0')
+            self.assertEqual(hostvars['second_node3']['inventory_hostname'], 'node3')
+            self.assertEqual(data['label3']['hosts'], ['first_node3', 'second_node3'])
+            self.assertNotIn('first', data)
+
+            masters = [{'jenkins_host': first.url}, {'jenkins_host': second.url}]
+            self.assertRaises(AnsibleError, self.get_inventory(masters).get_data_from_jenkins)
+
+    def test_masters_options(self):
+        '''
+        Tests that the options of every master are converted to their
+            type, and the unknown or invalid ones rejected.
+        '''
+        masters = [{'jenkins_host': 'http://first:8080/', 'timeout': '30', 'jenkins_jsessionid': 'yes',
+                    'target_latency': '0.5', 'engine': 'async'}]
+        plugin = self.get_inventory(masters)._get_master_plugins()[0]
+        self.assertEqual(plugin._options['timeout'], 30)
+        self.assertIs(plugin._options['jenkins_jsessionid'], True)
+        self.assertEqual(plugin._options['target_latency'], 0.5)
+        self.assertEqual(plugin._options['engine'], 'async')
+        self.assertEqual(plugin.master_name, 'first')
+
+        for option, value in (('timeot', 30), ('timeout', 'soon'), ('engine', 'fibers'), ('include', 'linux'),
+                              ('master_groups', True)):
+            masters = [{'jenkins_host': 'http://first:8080/', option: value}]
+            self.assertRaises(AnsibleError, self.get_inventory(masters)._get_master_plugins)
+
+    def test_masters_cached_apart(self):
+        '''
+        Tests that every master is cached on its own, so only the expired
+            ones are read, and the ones read are cached when another fails.
+        '''
+        fake_cache = {}
+        with FakeJenkins(nodes=5) as first, FakeJenkins(nodes=8) as second:
+            masters = [{'name': 'first', 'jenkins_host': first.url},
+                       {'name': 'second', 'jenkins_host': second.url}]
+            jenkins_inventory = self.get_inventory(masters, cache_format='compact')
+            jenkins_inventory._cache = MagicMock()
+            jenkins_inventory._cache.set.side_effect = fake_cache.__setitem__
+            jenkins_inventory._cache.get.side_effect = fake_cache.__getitem__
+
+            data = jenkins_inventory._get_masters_data(True, CACHE_TEST_KEY)
+            self.assertEqual(len(fake_cache), 2)
+            self.assertEqual((first.count(), second.count()), (6, 9))
+
+            del fake_cache[sorted(fake_cache)[0]]
+            self.assertEqual(jenkins_inventory._get_masters_data(True, CACHE_TEST_KEY), data)
+            self.assertIn((first.count(), second.count()), [(12, 9), (6, 18)])
+            self.assertEqual(len(fake_cache), 2)
+
+            # The failing master is not cached, the other one is
+            fake_cache.clear()
+            masters.append({'name': 'down', 'jenkins_host': 'http://127.0.0.1:1/', 'retries': 0})
+            self.assertRaises(AnsibleError, jenkins_inventory._get_masters_data, True, CACHE_TEST_KEY)
+            self.assertEqual(len(fake_cache), 2)
+
+
+class JenkinsInventory_Deadline_Tests(JenkinsTestCase):
+
+    def test_deadline(self):
+        '''
+        Tests that the computers not read before the deadline, or failing,
+            get their last data known, or are left out if there is none.
+        '''
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=10, slow_latency=3) as jenkins:
+                jenkins_inventory = self.get_inventory(jenkins.url, max_workers=4, engine=engine, retries=0, deadline=1,
+                                                       state_dir=os.path.join(self.state_dir, engine))
+                jenkins.slow_nodes = ['node2']
+                jenkins.broken_nodes = ['node5']
+                start = time.time()
+                data = jenkins_inventory.get_data_from_jenkins()
+                self.assertLess(time.time() - start, 2)
+                self.assertEqual(sorted(data['_meta']['hostvars']),
+                                 ['node{0}'.format(index) for index in (0, 1, 3, 4, 6, 7, 8, 9)])
+                self.assertEqual(jenkins_inventory._stale_computers, ['node2', 'node5'])
+
+                jenkins.slow_nodes = jenkins.broken_nodes = []
+                fresh_data = jenkins_inventory.get_data_from_jenkins()
+                self.assertEqual(len(fresh_data['_meta']['hostvars']), 10)
+                self.assertEqual(jenkins_inventory._stale_computers, [])
+
+                jenkins.slow_nodes = ['node2']
+                jenkins.broken_nodes = ['node5']
+                data = jenkins_inventory.get_data_from_jenkins()
+                for computer_name in ('node2', 'node5'):
+                    self.assertEqual(data['_meta']['hostvars'][computer_name],
+                                     dict(fresh_data['_meta']['hostvars'][computer_name], jenkins_stale=True))
+                self.assertIn('node5', data['label5']['hosts'])
+                self.assertNotIn('jenkins_stale', data['_meta']['hostvars']['node3'])
+
+                # Not cached with stale computers
+                jenkins_inventory._cache = MagicMock()
+                jenkins_inventory._write_cache(True, CACHE_TEST_KEY, data)
+                jenkins_inventory._cache.set.assert_not_called()
+
+    def test_deadline_login_listing(self):
+        '''
+        Tests that the deadline covers the login and the listing too, a
+            slow jenkins fails in time instead of waiting for the timeout.
+        '''
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=10, latency=0.8) as jenkins:
+                jenkins_inventory = self.get_inventory(jenkins.url, engine=engine, timeout=30, retries=5, deadline=1,
+                                                       state_dir=os.path.join(self.state_dir, engine), **LOGIN_OPTIONS)
+                start = time.time()
+                with self.assertRaises(AnsibleError):
+                    jenkins_inventory.get_data_from_jenkins()
+                self.assertLess(time.time() - start, 1.5)
+                # Login and listing, not retried once the deadline passed
+                self.assertEqual(jenkins.count(), 2)
+
+    def test_deadline_retries(self):
+        '''
+        Tests that the failed requests are not retried, nor wait for
+            their backoff, past the deadline.
+        '''
+        # Nobody listens there
+        jenkins_inventory = self.get_inventory('http://127.0.0.1:1/', retries=20, deadline=1)
+        start = time.time()
+        with self.assertRaises(AnsibleError):
+            jenkins_inventory.get_data_from_jenkins()
+        self.assertLess(time.time() - start, 1.5)
+
+
+class JenkinsInventory_Metrics_Tests(JenkinsTestCase):
+
+    def test_metrics_file(self):
+        '''
+        Tests that every run appends its timings and counters, the same
+            ones jenkins saw, to the metrics file.
+        '''
+        metrics_file = os.path.join(self.state_dir, 'metrics.json')
+        for engine in ('threads', 'async'):
+            with FakeJenkins(nodes=20, busy=3) as jenkins:
+                for _ in range(2):
+                    # A computer could get every busy answer
+                    jenkins_inventory = self.get_inventory(jenkins.url, max_workers=4, engine=engine, retries=3,
+                                                           node_cache=True, metrics_file=metrics_file, **LOGIN_OPTIONS)
+                    jenkins_inventory.get_data_from_jenkins()
+                    jenkins_inventory._report_metrics()
+
+                with open(metrics_file) as f:
+                    runs = [json.loads(line) for line in f]
+                os.remove(metrics_file)
+
+                self.assertEqual(len(runs), 2)
+                self.assertEqual(sum(run['counters']['requests'] for run in runs), jenkins.count())
+                self.assertEqual(runs[0]['counters']['retries'], 3)
+                self.assertEqual(runs[0]['counters']['node_cache_misses'], 20)
+                self.assertEqual(runs[1]['counters']['node_cache_hits'], 20)
+                self.assertGreater(runs[0]['counters']['bytes'], 0)
+                self.assertEqual(runs[0]['jenkins_host'], jenkins.url)
+                self.assertEqual(runs[0]['nodes'], 20)
+                self.assertEqual(len(runs[0]['slowest_nodes']), 10)
+                for phase in ('login', 'listing', 'fetch', 'xml_parse'):
+                    self.assertGreater(runs[0]['phases'][phase], 0)
+
+    def test_cache_counters(self):
+        '''
+        Tests that an empty ansible cache counts a miss, and a filled one a hit.
+        '''
+        jenkins_inventory = InventoryModule()
+        jenkins_inventory._cache = CachePluginAdjudicator(plugin_name='memory')
+
+        self.assertIsNone(jenkins_inventory._read_cache(True, CACHE_TEST_KEY))
+        jenkins_inventory._write_cache(True, CACHE_TEST_KEY, {'compact': False})
+        self.assertEqual(jenkins_inventory._read_cache(True, CACHE_TEST_KEY), {'compact': False})
+
+        self.assertEqual(jenkins_inventory._metrics.counters['cache_misses'], 1)
+        self.assertEqual(jenkins_inventory._metrics.counters['cache_hits'], 1)
+
+
+class JenkinsInventory_Startup_Tests(JenkinsTestCase):
+
+    def test_cache_hit_lazy_modules(self):
+        '''
+        Tests that a parse from the cache, in a new interpreter, doesn't
+            load the modules only needed to read jenkins.
+        '''
+        with FakeJenkins(nodes=10) as jenkins:
+            inventory_path = os.path.join(self.state_dir, 'test.jenkins.yml')
+            with open(inventory_path, 'w') as inventory_file:
+                inventory_file.write('plugin: jenkins\njenkins_host: {0}\ncache: true\ncache_plugin: jsonfile\n'
+                                     'cache_connection: {1}\n'.format(jenkins.url, self.state_dir))
+            miss = startup_parse(inventory_path)
+            requests = jenkins.count()
+            hit = startup_parse(inventory_path)
+            self.assertEqual(jenkins.count(), requests)
+
+        self.assertIn('lxml.etree', miss['loaded'])
+        self.assertEqual(hit['hosts'], 10)
+        self.assertEqual(hit['loaded'], [])
+
+
+class JenkinsInventory_StaleWhileRevalidate_Tests(JenkinsTestCase):
+
+    def get_inventory(self, jenkins_host, **options):
+        jenkins_inventory = super(JenkinsInventory_StaleWhileRevalidate_Tests, self).get_inventory(
+            jenkins_host, cache=True, cache_mode='stale_while_revalidate', **options)
+        jenkins_inventory._cache = self.get_cache()
+        return jenkins_inventory
+
+    def get_cache(self):
+        # As every ansible run loads it
+        return CachePluginAdjudicator(plugin_name='jsonfile', _uri=os.path.join(self.state_dir, 'cache'),
+                                      _timeout=60)
+
+    def expire_cache(self):
+        cache_dir = os.path.join(self.state_dir, 'cache')
+        for cache_file in os.listdir(cache_dir):
+            os.utime(os.path.join(cache_dir, cache_file), (time.time() - 120, time.time() - 120))
+
+    @patch.object(BaseInventoryPlugin, 'parse')
+    @patch.object(InventoryModule, '_read_config_data')
+    @patch.object(InventoryModule, '_add_composed_hostvars')
+    @patch.object(InventoryModule, '_data_2_inventory')
+    @patch.object(InventoryModule, 'get_data_from_jenkins', return_value='jenkins data')
+    @patch.object(InventoryModule, '_refresh_in_background')
+    @patch.object(InventoryModule, 'get_cache_key', return_value=CACHE_TEST_KEY)
+    def test_parse_stale(self,
+                         get_cache_key_mock,
+                         _refresh_in_background_mock,
+                         get_data_from_jenkins_mock,
+                         _data_2_inventory_mock,
+                         _add_composed_hostvars_mock,
+                         _read_config_mock,
+                         base_parse_mock):
+        '''
+        Tests that an expired cache is served right away while it is
+            refreshed in the background, unless it is too old.
+        '''
+        jenkins_inventory = self.get_inventory('http://127.0.0.1:8080/')
+
+        # Nothing read yet, we must wait for jenkins
+        jenkins_inventory.parse(None, None, None)
+        get_data_from_jenkins_mock.assert_called_once()
+        self.assertEqual(self.get_cache().get(CACHE_TEST_KEY), 'jenkins data')
+        _refresh_in_background_mock.assert_not_called()
+
+        # Cached
+        get_data_from_jenkins_mock.reset_mock()
+        jenkins_inventory._cache = self.get_cache()
+        jenkins_inventory.parse(None, None, None)
+        get_data_from_jenkins_mock.assert_not_called()
+        _refresh_in_background_mock.assert_not_called()
+
+        self.expire_cache()
+        jenkins_inventory._cache = self.get_cache()
+        jenkins_inventory.parse(None, None, None)
+        get_data_from_jenkins_mock.assert_not_called()
+        _refresh_in_background_mock.assert_called_once_with(CACHE_TEST_KEY)
+        _data_2_inventory_mock.assert_called_with('jenkins data')
+
+        _refresh_in_background_mock.reset_mock()
+        jenkins_inventory._options['max_stale'] = -1
+        jenkins_inventory._cache = self.get_cache()
+        jenkins_inventory.parse(None, None, None)
+        get_data_from_jenkins_mock.assert_called_once()
+        _refresh_in_background_mock.assert_not_called()
+
+    def test_refresh_in_background(self):
+        '''
+        Tests that the background refresh rewrites the stale data.
+        '''
+        with FakeJenkins(nodes=5) as jenkins:
+            jenkins_inventory = self.get_inventory(jenkins.url)
+            stale_file = jenkins_inventory._get_state_file('stale', CACHE_TEST_KEY)
+            jenkins_inventory._save_stale_data(CACHE_TEST_KEY, 'old data')
+
+            jenkins_inventory._refresh_in_background(CACHE_TEST_KEY)
+
+            for _ in range(100):
+                stale = jenkins_inventory._read_state(stale_file)
+                if stale['data'] != 'old data':
+                    break
+                time.sleep(0.05)
+
+        self.assertEqual(len(stale['data']['_meta']['hostvars']), 5)
+
+
 if __name__ == '__main__':
     unittest.main()